@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+# jsh: JSON-RPC standards for the shell
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""
+Benchmarks for jshlib and bin/jsh.
+
+Run all of them and save the json results:
+
+    python benchmarks/bench.py > before.json
+
+Then compare the results of two commits:
+
+    python benchmarks/bench.py compare before.json after.json
+
+Throughput is the best of ``--repeat`` runs over generated corpora of about
+``--size-mb`` each. Latencies are the median of ``--calls`` calls.
+"""
+
+# pylint: disable=invalid-name
+
+from __future__ import unicode_literals, division
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCHMARKS)
+JSH = os.path.join(REPO, 'bin', 'jsh')
+ECHO = os.path.join(REPO, 'tests', 'echo')
+
+sys.path.insert(0, REPO)
+import jshlib  # pylint: disable=wrong-import-position
+
+# the jsh processes import this checkout of jshlib
+os.environ['PYTHONPATH'] = os.pathsep.join(
+    p for p in (REPO, os.environ.get('PYTHONPATH')) if p)
+
+WORDS = ('build', 'error', 'warning', 'file', 'target', 'link', 'compile',
+         'cache', 'miss', 'hit', 'ünïcode', 'tab\tand "quotes"')
+
+
+def corpus_small_objects(rng, size):
+    """NDJSON of small flat objects."""
+    i = 0
+    while size > 0:
+        value = {
+            "id": i,
+            "name": rng.choice(WORDS),
+            "ok": rng.random() > 0.5,
+            "score": rng.random(),
+        }
+        i += 1
+        size -= yield value
+
+
+def corpus_nested(rng, size):
+    """A few big documents of nested objects and lists."""
+    def tree(depth):
+        if depth == 0:
+            return [rng.randint(0, 1000), rng.choice(WORDS), None]
+        return {
+            "name": rng.choice(WORDS),
+            "children": [tree(depth - 1) for _ in range(6)],
+        }
+
+    while size > 0:
+        size -= yield tree(5)
+
+
+def corpus_numbers(rng, size):
+    """A stream of bare integers and floats."""
+    while size > 0:
+        if rng.random() > 0.5:
+            value = rng.randint(-10**9, 10**9)
+        else:
+            value = rng.uniform(-1e6, 1e6)
+        size -= yield value
+
+
+def corpus_strings(rng, size):
+    """A stream of strings, some with escapes and non-ascii characters."""
+    while size > 0:
+        size -= yield ' '.join(rng.choice(WORDS) for _ in range(8))
+
+
+def corpus_logs(rng, size):
+    """A log stream, mostly INFO, with some data attached."""
+    i = 0
+    while size > 0:
+        value = jshlib.log_payload(
+            "step {} {}".format(i, rng.choice(WORDS)),
+            lvl=jshlib.ERROR if rng.random() < 0.05 else jshlib.INFO,
+            data={"target": "//src/{}:{}".format(i % 97, rng.choice(WORDS)),
+                  "ms": rng.randint(0, 5000)})
+        i += 1
+        size -= yield value
+
+
+CORPORA = {
+    'small_objects': corpus_small_objects,
+    'nested': corpus_nested,
+    'numbers': corpus_numbers,
+    'strings': corpus_strings,
+    'logs': corpus_logs,
+}
+
+
+def generate(name, size):
+    """Return (values, ndjson bytes) of about ``size`` bytes."""
+    gen = CORPORA[name](random.Random(name), size)
+    values = []
+    lines = []
+    try:
+        value = next(gen)
+        while True:
+            values.append(value)
+            line = json.dumps(value, ensure_ascii=False).encode('utf-8')
+            lines.append(line)
+            value = gen.send(len(line) + 1)
+    except StopIteration:
+        pass
+    lines.append(b'')
+    return values, b'\n'.join(lines)
+
+
+def best_of(repeat, fn):
+    """The fastest time of calling ``fn`` ``repeat`` times."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def throughput(name, corpus, records, nbytes, seconds):
+    return {
+        "name": name,
+        "corpus": corpus,
+        "records": records,
+        "bytes": nbytes,
+        "seconds": seconds,
+        "records_per_s": records / seconds,
+        "mb_per_s": nbytes / seconds / 1e6,
+    }
+
+
+def latency(name, times):
+    times = sorted(times)
+    return {
+        "name": name,
+        "calls": len(times),
+        "median_ms": times[len(times) // 2] * 1e3,
+        "min_ms": times[0] * 1e3,
+        "max_ms": times[-1] * 1e3,
+    }
+
+
+def bench_load(corpus, values, data, repeat):
+    yield throughput(
+        "load_json_iter", corpus, len(values), len(data),
+        best_of(repeat, lambda: list(jshlib.load_json_iter(data))))
+
+    def load_stream():
+        list(jshlib.load_json_iter(io.BytesIO(data)))
+
+    yield throughput("load_json_iter_stream", corpus, len(values), len(data),
+                     best_of(repeat, load_stream))
+
+    yield throughput(
+        "parallel_load", corpus, len(values), len(data),
+        best_of(repeat, lambda: list(jshlib.parallel_load(data))))
+
+    framed = io.BytesIO()
+    with jshlib.RecordWriter(framed,
+                             framing=jshlib.FRAMING_NETSTRING) as writer:
+        writer.write_many(values)
+    framed = framed.getvalue()
+    yield throughput(
+        "load_json_iter_netstring", corpus, len(values), len(framed),
+        best_of(
+            repeat, lambda: list(
+                jshlib.load_json_iter(framed,
+                                      framing=jshlib.FRAMING_NETSTRING))))
+
+
+def bench_dump(corpus, values, data, repeat):
+    def dump_stdout():
+        with io.open(os.devnull, 'w', encoding='utf-8') as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                for value in values:
+                    jshlib.dump_stdout(value)
+                jshlib.stdout_writer().flush()
+            finally:
+                sys.stdout = stdout
+
+    def write_many():
+        jshlib.RecordWriter(io.BytesIO()).write_many(values)
+
+    yield throughput("dump_stdout", corpus, len(values), len(data),
+                     best_of(repeat, dump_stdout))
+    yield throughput("RecordWriter.write_many", corpus, len(values),
+                     len(data), best_of(repeat, write_many))
+
+
+def bench_processes(calls):
+    def timed(fn):
+        times = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        return times
+
+    def round_trip():
+        rc, outputs, _ = jshlib.run_jsh(ECHO, "echo", inputs=[{"a": 1}])
+        assert rc == 0 and outputs == [{"a": 1}], outputs
+
+    yield latency("run_jsh_round_trip", timed(round_trip))
+
+    with jshlib.WorkerPool(ECHO, size=1) as pool:
+        yield latency("WorkerPool.call",
+                      timed(lambda: pool.call("echo", {"a": 1})))
+
+    def cold_start():
+        subprocess.check_output([JSH, "m=foo", "--a=1"])
+
+    yield latency("jsh_cold_start", timed(cold_start))
+
+
+def run(args):
+    results = []
+    if not args.skip_throughput:
+        for corpus in sorted(CORPORA):
+            values, data = generate(corpus, int(args.size_mb * 1e6))
+            results.extend(bench_load(corpus, values, data, args.repeat))
+            results.extend(bench_dump(corpus, values, data, args.repeat))
+    if not args.skip_processes:
+        results.extend(bench_processes(args.calls))
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "codec": jshlib.get_codec().name,
+        "size_mb": args.size_mb,
+        "results": results,
+    }
+
+
+def compare(before, after):
+    """Return a line per benchmark with the ratio of after to before."""
+    def by_key(doc):
+        return {(r["name"], r.get("corpus")): r for r in doc["results"]}
+
+    old = by_key(before)
+    lines = []
+    for key, new in sorted(by_key(after).items(),
+                           key=lambda kv: (kv[0][0], kv[0][1] or '')):
+        if key not in old:
+            continue
+        if "mb_per_s" in new:
+            metric, higher = "mb_per_s", True
+        else:
+            metric, higher = "median_ms", False
+        ratio = new[metric] / old[key][metric]
+        faster = ratio if higher else 1 / ratio
+        lines.append("{:<28} {:<14} {:>10.2f} -> {:>10.2f} {} ({:.2f}x)".format(
+            key[0], key[1] or '', old[key][metric], new[metric], metric,
+            faster))
+    return lines
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    sub = parser.add_subparsers(dest='command')
+
+    parser.add_argument('--size-mb', type=float, default=2.0,
+                        help='approximate size of each corpus')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='throughput runs, the best is kept')
+    parser.add_argument('--calls', type=int, default=20,
+                        help='calls for each latency benchmark')
+    parser.add_argument('--skip-throughput', action='store_true')
+    parser.add_argument('--skip-processes', action='store_true')
+
+    cmp_parser = sub.add_parser('compare', help='compare two result files')
+    cmp_parser.add_argument('before')
+    cmp_parser.add_argument('after')
+
+    args = parser.parse_args(argv[1:])
+    if args.command == 'compare':
+        with io.open(args.before) as f:
+            before = json.load(f)
+        with io.open(args.after) as f:
+            after = json.load(f)
+        print('\n'.join(compare(before, after)))
+        return 0
+
+    print(json.dumps(run(args), indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
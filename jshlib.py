@@ -20,13 +20,40 @@ jsh: JSON-RPC standards for the shell
 # pylint: disable=invalid-name,too-few-public-methods
 
 from __future__ import unicode_literals
+import os
+import io
 import sys
+import re
+import codecs
 import json
-import subprocess
-import traceback
-import io
+import functools
+import itertools
+import time
+import atexit
+import _thread
+
+# Only modules which are already loaded by ``json`` (or are builtin) are
+# imported here. Heavier ones (subprocess, threading, concurrent.futures,
+# tempfile, traceback, etc) are imported where they are used, so that
+# commands which only parse their request and dump a few records start
+# quickly. PopenJsh is in jshlib_process for the same reason.
+# pylint: disable=import-outside-toplevel
 
 ARGV_JSH_REQUEST = '--jsh-request'
+ARGV_JSH_REQUEST_FD = '--jsh-request-fd'
+ARGV_JSH_REQUEST_FILE = '--jsh-request-file'
+ARGV_JSH_SERVE = '--jsh-serve'
+ARGV_JSH_FRAMING = '--jsh-framing'
+
+# How a request is sent to a jsh command, see RequestTransport
+TRANSPORT_ARGV = 'argv'
+TRANSPORT_FD = 'fd'
+TRANSPORT_FILE = 'file'
+
+# How records are framed on a jsh command's stdout, see RecordWriter
+FRAMING_LINES = 'lines'
+FRAMING_NETSTRING = 'netstring'
+FRAMINGS = (FRAMING_LINES, FRAMING_NETSTRING)
 
 CODE = 'code'
 DATA = 'data'
@@ -35,129 +62,1001 @@ MESSAGE = 'message'
 JSONRPC = 'jsonrpc'
 JSONRPC_VALUE = '2.0'
 PARAMS = 'params'
+ID = 'id'
+RESULT = 'result'
+RPC_ERROR = 'error'
+
+OUT = 'out'
+LOG = 'log'
 
 INFO = 'INFO'
 ERROR = 'ERROR'
 
-_DIGITS = {str(n) for n in range(10)}
-_DIGITS.add('.')
-_CURLY = {'{', '}'}
-_BRACKET = {'[', ']'}
-
-def run_jsh(cmd, method, params=None, inputs=None):
+JSON_CODEC_ENV = 'JSH_JSON_CODEC'
+CACHE_DIR_ENV = 'JSH_CACHE_DIR'
+STATS_ENV = 'JSH_STATS'
+CODEC_NAMES = ('orjson', 'ujson', 'rapidjson', 'json')
+
+CHUNK_SIZE = 64 * 1024
+# Requests larger than this are not sent through argv, which is limited by
+# ARG_MAX and visible in ``ps``.
+REQUEST_ARGV_MAX = 32 * 1024
+
+_STD_WRITERS = {}
+_REQUEST_TEMPLATES = {}
+_STDOUT_FRAMING = FRAMING_LINES
+# the most digits of a netstring's length
+_FRAME_HEAD_MAX = 20
+# the bytes of each chunk decoded by a parallel_load worker
+PARALLEL_CHUNK_SIZE = 4 * 1024 * 1024
+_INF = float('inf')
+
+_DECODER = json.JSONDecoder()
+_SCAN_ONCE = _DECODER.scan_once
+_WS_MATCH = re.compile(r'[ \t\n\r]*').match
+_NUMBER_START = frozenset('-0123456789')
+_VALUE_START = frozenset('{["-0123456789tfnNI')
+_STRUCTURE_SEARCH = re.compile(r'["{}\[\]]').search
+_STRING_BODY_MATCH = re.compile(r'(?:[^"\\]+|\\.)*', re.DOTALL).match
+_SCALAR_END_SEARCH = re.compile(r'[^0-9A-Za-z+\-.]').search
+_STRING_SUB = re.compile(r'"[^"\\]*"').sub
+_BYTES_TYPES = (bytes, bytearray, memoryview)
+_PATH_TYPES = (os.PathLike, )
+# inheriting a file descriptor requires Popen's pass_fds
+_HAS_PASS_FDS = os.name == 'posix'
+
+
+def run_jsh(cmd,
+            method,
+            params=None,
+            inputs=None,
+            cache=None,
+            stats=None,
+            **limits):
     """Run a Jsh process, blocking until it is complete.
 
     `inputs` can be a list of serializable values to dump into the stream.
 
+    `cache` can be a ResultCache, which returns the stored result of an
+    identical call instead of starting the process.
+
+    `stats` can be a CallStats which is filled in for the process.
+
+    `limits` are ``timeout``, ``max_output_bytes``, ``max_records`` and
+    ``rlimit``, see `PopenJsh.run_jsh`. If one is exceeded the records read
+    so far are returned and the last log is an Error naming the limit.
+
     Returns (returncode, outputs, logs)
 
     rc: integer return code
     outputs: list of python objects from stdout
     logs: list of python objects from stderr
     """
+    if cache is not None:
+        return cache.run_jsh(cmd, method, params, inputs, stats=stats, **limits)
+    from jshlib_process import PopenJsh
     inputs = inputs or ""
-    p = PopenJsh.run_jsh(cmd=cmd, method=method, params=params)
+    p = PopenJsh.run_jsh(cmd=cmd,
+                         method=method,
+                         params=params,
+                         stats=stats,
+                         **limits)
     outputs, logs = p.communicate(inputs=inputs)
     return p.returncode, outputs, logs
 
 
-class PopenJsh(subprocess.Popen):
-    """Run a Jsh process in the background using Popen.
+def run_jsh_many(calls, max_workers=None, ordered=False, fail_fast=False):
+    """Run many Jsh processes, at most ``max_workers`` at a time.
 
-    Use the `run_jsh` classmethod to start it, or construct your own Popen.
+    `calls` is an iterable of ``(cmd, method[, params[, inputs]])`` tuples or
+    dicts of ``PopenJsh.run_jsh`` keyword arguments (plus ``inputs``). It is
+    consumed lazily, so it can be a generator of any length.
 
-    This is similar to Popen but provides a generator for reading the logs and
-    data.
+    Yields (index, returncode, outputs, logs) as each process finishes, or in
+    the order of `calls` if ``ordered``.
 
-    TODO:
-    Currently this only provides the `communicate` method. Eventually it might
-    implement the generator interface (in python3 only).
+    If ``fail_fast``, no more calls are started after the first non-zero
+    returncode, running processes are killed and the failed call is the last
+    one yielded. If ``ordered``, the calls before it which have finished are
+    yielded first (the earlier calls which were still running are not).
     """
-    @classmethod
-    def run_jsh(cls,
+    # pylint: disable=too-many-locals
+    import threading
+    from concurrent import futures
+    max_workers = max_workers or os.cpu_count() or 1
+    calls = enumerate(calls)
+    running = {}
+    finished = {}
+    live = set()
+    stop = threading.Event()
+    next_index = 0
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            while True:
+                for index, call in itertools.islice(
+                        calls, max_workers - len(running)):
+                    future = executor.submit(_run_call, call, live, stop)
+                    running[future] = index
+                if not running:
+                    return
+
+                done, _ = futures.wait(running,
+                                       return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    rc, outputs, logs = future.result()
+                    result = (index, rc, outputs, logs)
+                    if fail_fast and rc != 0:
+                        for prior in sorted(i for i in finished if i < index):
+                            yield finished.pop(prior)
+                        yield result
+                        return
+
+                    if not ordered:
+                        yield result
+                        continue
+
+                    finished[index] = result
+                    while next_index in finished:
+                        yield finished.pop(next_index)
+                        next_index += 1
+        finally:
+            stop.set()
+            for p in list(live):
+                p.kill()
+
+
+def _run_call(call, live, stop):
+    """Run a single call for run_jsh_many, tracking the live process.
+
+    Nothing is started once ``stop`` is set, and a process started while it
+    was being set is killed here.
+    """
+    from jshlib_process import PopenJsh
+    if stop.is_set():
+        return None
+    if isinstance(call, dict):
+        kwargs = dict(call)
+    else:
+        kwargs = dict(zip(('cmd', 'method', 'params', 'inputs'), call))
+    inputs = kwargs.pop('inputs', None)
+
+    p = PopenJsh.run_jsh(**kwargs)
+    live.add(p)
+    try:
+        if stop.is_set():
+            p.kill()
+        outputs, logs = p.communicate(inputs=inputs)
+    finally:
+        live.discard(p)
+    return p.returncode, outputs, logs
+
+
+class ResultCache(object):
+    """An on-disk cache of `run_jsh` results for pure jsh methods.
+
+    A result is stored under the hash of the resolved command path, its
+    mtime and size (or its contents if ``hash_cmd``), the serialized
+    Request and the input records, so an unchanged call returns
+    ``(rc, outputs, logs)`` without starting a process.
+
+    The cache is in ``path`` (default ``$JSH_CACHE_DIR`` or ``~/.cache/jsh``)
+    and the least recently used results are removed when it grows beyond
+    ``max_bytes``. Methods named in ``impure`` are always run, as are
+    commands which can't be found. Failed calls (a non-zero rc) are only
+    stored if ``cache_failures``.
+    """
+    def __init__(self,
+                 path=None,
+                 max_bytes=256 * 1024 * 1024,
+                 impure=(),
+                 hash_cmd=False,
+                 cache_failures=False):
+        if path is None:
+            path = os.environ.get(CACHE_DIR_ENV) or os.path.join(
+                os.path.expanduser('~'), '.cache', 'jsh')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.impure = frozenset(impure)
+        self.hash_cmd = hash_cmd
+        self.cache_failures = cache_failures
+        self._size = None
+        self._cmd_hashes = {}
+        self._lock = _thread.allocate_lock()
+
+    # pylint: disable=too-many-arguments
+    def run_jsh(self,
                 cmd,
                 method,
                 params=None,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                **kwargs):
-        r = request(method=method, params=params)
-        args = [cmd, "--jsh-request={}".format(json.dumps(r))]
-
-        return cls(args=args,
-                   stdin=stdin,
-                   stderr=stderr,
-                   stdout=stdout,
-                   **kwargs)
-
-    def communicate(self, inputs=None):
-        """Communicate with the jsh process, returning the deserialized
-        stdout, stderr.
-
-        `inputs` can be a list of serializable values to dump into the stream.
+                inputs=None,
+                stats=None,
+                **limits):
+        """`run_jsh` with the cache. ``inputs`` are read into a list.
+
+        ``stats`` and ``limits`` only apply if the process is run. A call
+        which exceeded a limit failed, so it is only stored if
+        ``cache_failures``.
         """
-
-        if inputs:
-            strinput = '\n'.join(json.dumps(v) for v in inputs)
-            if sys.version_info[0] >= 3:
-                strinput = strinput.encode('utf-8')
-
+        inputs = list(inputs or ())
+        key = None
+        if method not in self.impure:
+            key = self.key(cmd, method, params, inputs)
+        if key is None:
+            return run_jsh(cmd, method, params, inputs, stats=stats, **limits)
+
+        result = self.get(key)
+        if result is None:
+            result = run_jsh(cmd,
+                             method,
+                             params,
+                             inputs,
+                             stats=stats,
+                             **limits)
+            if result[0] == 0 or self.cache_failures:
+                self.put(key, result)
+        return result
+
+    def key(self, cmd, method, params=None, inputs=None):
+        """The hex key of a call, or None if the command can't be found."""
+        import hashlib
+        path = _resolve_cmd(cmd)
+        if path is None:
+            return None
+        st = os.stat(path)
+        h = hashlib.sha256()
+        h.update(path.encode('utf-8') + b'\0')
+        if self.hash_cmd:
+            h.update(self._hash_file(path, st).encode('utf-8'))
         else:
-            strinput = None
+            h.update('{}:{}'.format(st.st_mtime_ns, st.st_size).encode('utf-8'))
+        h.update(b'\0' + _canonical_json(request(method, params)) + b'\0')
+        for value in inputs or ():
+            h.update(_canonical_json(value) + b'\n')
+        return h.hexdigest()
+
+    def get(self, key):
+        """Return the stored ``(rc, outputs, logs)`` or None."""
+        path = self._entry(key)
+        try:
+            with io.open(path, 'rb') as f:
+                entry = _CODEC.loads(f.read().decode('utf-8'))
+            os.utime(path, None)  # mark it as recently used
+        except (IOError, OSError, ValueError):
+            return None
+        return entry['rc'], entry['outputs'], entry['logs']
+
+    def put(self, key, result):
+        """Store ``(rc, outputs, logs)``, evicting old results if needed."""
+        rc, outputs, logs = result
+        data = _CODEC.dumps({
+            'rc': rc,
+            'outputs': outputs,
+            'logs': logs,
+        }).encode('utf-8')
+        import tempfile
+        path = self._entry(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # write then rename, so readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        with self._lock:
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.replace(tmp, path)
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(data) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def clear(self):
+        """Remove every stored result."""
+        with self._lock:
+            for path, _, _ in self._entries():
+                _remove_quietly(path)
+            self._size = 0
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def _entries(self):
+        """Yield ``(path, size, mtime)`` of every entry."""
+        if not os.path.isdir(self.path):
+            return
+        for directory in os.listdir(self.path):
+            directory = os.path.join(self.path, directory)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache is below
+        its limit, leaving room for new ones."""
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        size = sum(e[1] for e in entries)
+        target = self.max_bytes * 3 // 4
+        for path, entry_size, _ in entries:
+            if size <= target:
+                break
+            _remove_quietly(path)
+            size -= entry_size
+        self._size = size
+
+    def _hash_file(self, path, st):
+        """Hash of a command's contents, remembered while it is unchanged."""
+        stamp = (path, st.st_mtime_ns, st.st_size)
+        digest = self._cmd_hashes.get(stamp)
+        if digest is None:
+            import hashlib
+            h = hashlib.sha256()
+            with io.open(path, 'rb') as f:
+                for chunk in iter(functools.partial(f.read, CHUNK_SIZE), b''):
+                    h.update(chunk)
+            digest = self._cmd_hashes[stamp] = h.hexdigest()
+        return digest
+
+
+def _resolve_cmd(cmd):
+    """The real path of the command which would be run, or None."""
+    import shutil
+    path = cmd if os.path.dirname(cmd) else shutil.which(cmd)
+    if path is None or not os.path.isfile(path):
+        return None
+    return os.path.realpath(path)
+
+
+def _canonical_json(value):
+    """Utf-8 json of a value which doesn't depend on the codec or key
+    order."""
+    return json.dumps(value,
+                      sort_keys=True,
+                      separators=(',', ':'),
+                      default=_serialize_default).encode('utf-8')
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class _LimitExceeded(Exception):
+    """A limit of a PopenJsh was exceeded."""
+    def __init__(self, limit, value):
+        super(_LimitExceeded, self).__init__(limit)
+        self.limit = limit
+        self.value = value
+
+    def error(self, returncode):
+        return Error(code=Error.LIMIT_EXCEEDED,
+                     message="jsh {} limit exceeded".format(self.limit),
+                     data={
+                         'limit': self.limit,
+                         'value': self.value,
+                         'returncode': returncode,
+                     })
+
+
+def pipeline(stages, inputs=None):
+    """Run jsh processes connected stdout to stdin with OS pipes.
+
+    `stages` is a list of ``(cmd, method[, params])`` tuples. The records
+    between stages never pass through python, so the stages run in parallel
+    at the speed of the pipes. `inputs` are fed to the first stage.
+
+    returns: a running Pipeline. Use its `iter_records` or `communicate`.
+    """
+    return Pipeline(stages, inputs=inputs)
+
 
-        stdout, stderr = super(PopenJsh, self).communicate(strinput)
-        if sys.version_info[0] >= 3:
-            stdout, stderr = stdout.decode('utf-8'), stderr.decode('utf-8')
+class Pipeline(object):
+    """Jsh processes connected stdout to stdin, see `pipeline`.
 
-        outputs = list(load_json_iter(stdout))
-        logs = list(load_json_iter(stderr))
+    ``processes`` are the PopenJsh of each stage.
+    """
+    def __init__(self, stages, inputs=None):
+        import subprocess
+        from jshlib_process import PopenJsh
+        self.processes = []
+        self._inputs = inputs
+        try:
+            for stage in stages:
+                prev = self.processes[-1] if self.processes else None
+                stdin = prev.stdout if prev else subprocess.PIPE
+                p = PopenJsh.run_jsh(*stage, stdin=stdin)
+                if prev:
+                    # only the next stage reads from it
+                    prev.stdout.close()
+                    prev.stdout = None
+                self.processes.append(p)
+        except Exception:
+            self.kill()
+            raise
+
+    @property
+    def returncodes(self):
+        """The return code of each stage, None if it is still running."""
+        return [p.returncode for p in self.processes]
+
+    def iter_records(self):
+        """Yield ``(index, kind, obj)`` records: the ``OUT`` records of the
+        last stage and the ``LOG`` records of every stage, tagged with the
+        stage ``index``.
+
+        The processes are waited on once all pipes are closed.
+        """
+        # pylint: disable=protected-access
+        last = len(self.processes) - 1
+        readers = [(p.stderr, (index, LOG),
+                    JsonStreamParser(stats=p._stream_stats(LOG)))
+                   for index, p in enumerate(self.processes)]
+        p = self.processes[last]
+        readers.append((p.stdout, (last, OUT),
+                        JsonStreamParser(stats=p._stream_stats(OUT),
+                                         framing=p._framing)))
+
+        stdin = self.processes[0].stdin
+        for (index, kind), value in _iter_pipes(stdin, self._inputs, readers):
+            yield index, kind, value
+
+        for p in self.processes:
+            p.wait()
+
+    def communicate(self):
+        """Run the pipeline to completion.
+
+        returns: (outputs, logs) where outputs are the records of the last
+          stage and logs are ``(index, obj)`` tuples of every stage.
+        """
+        outputs, logs = [], []
+        for index, kind, value in self.iter_records():
+            if kind == OUT:
+                outputs.append(value)
+            else:
+                logs.append((index, value))
         return outputs, logs
 
+    def kill(self):
+        """Kill every stage."""
+        for p in self.processes:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+
+
+def _iter_pipes(stdin, inputs, readers, deadline=None, max_bytes=None):
+    """Write `inputs` to ``stdin`` while reading json records from
+    ``readers``, a list of ``(pipe, tag, parser)``. Missing pipes are skipped.
+
+    Yields ``(tag, obj)`` records until all of the readers are closed.
+
+    raise: _LimitExceeded once ``time.monotonic()`` passes ``deadline``
+      ('timeout') or a pipe's data passes ``max_bytes[tag]``
+      ('max_output_bytes'). The records before the limit are yielded first.
+    """
+    # pylint: disable=too-many-branches
+    import selectors
+    chunks = _iter_input_chunks(inputs)
+    selector = selectors.DefaultSelector()
+    parsers = {}
+    try:
+        if stdin:
+            pending = memoryview(next(chunks, b''))
+            if pending:
+                os.set_blocking(stdin.fileno(), False)
+                selector.register(stdin, selectors.EVENT_WRITE)
+            else:
+                stdin.close()
+
+        for pipe, tag, parser in readers:
+            if pipe:
+                key = selector.register(pipe, selectors.EVENT_READ, tag)
+                parsers[key.fd] = parser
+
+        while selector.get_map():
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise _LimitExceeded('timeout', None)
+            for key, _ in selector.select(timeout):
+                if key.fileobj is stdin:
+                    try:
+                        pending = pending[os.write(key.fd, pending):]
+                    except BlockingIOError:
+                        continue
+                    except BrokenPipeError:
+                        # the process stopped reading, drop the rest
+                        chunks = iter(())
+                        pending = pending[:0]
+                    if not pending:
+                        pending = memoryview(next(chunks, b''))
+                    if not pending:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                    continue
+
+                data = os.read(key.fd, CHUNK_SIZE)
+                parser = parsers[key.fd]
+                left = max_bytes.get(key.data) if max_bytes else None
+                if left is not None:
+                    if len(data) > left:
+                        for value in parser.feed(data[:left]):
+                            yield key.data, value
+                        raise _LimitExceeded('max_output_bytes', None)
+                    max_bytes[key.data] = left - len(data)
+                if data:
+                    values = parser.feed(data)
+                else:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    values = parser.close()
+
+                for value in values:
+                    yield key.data, value
+    finally:
+        selector.close()
+
+
+class WorkerPool(object):
+    """A pool of warm ``--jsh-serve`` jsh processes.
+
+    Each worker is a PopenJsh started with ``[cmd, ARGV_JSH_SERVE]`` which
+    handles one request at a time. `call` routes a request to an idle worker,
+    so the pool can be shared between threads. A worker which dies is
+    replaced.
+
+    stderr of the workers is inherited unless ``stderr`` is given.
+    """
+    def __init__(self, cmd, size=None, **kwargs):
+        self.cmd = cmd
+        self.size = size or os.cpu_count() or 1
+        self._kwargs = kwargs
+        import queue
+        self._ids = itertools.count()
+        self._lock = _thread.allocate_lock()
+        self._idle = queue.Queue()
+        self._workers = set()
+        for _ in range(self.size):
+            self._idle.put(self._spawn())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _spawn(self):
+        worker = _ServeWorker(self.cmd, **self._kwargs)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def call(self, method, params=None):
+        """Call the method on an idle worker, blocking until it responds.
+
+        returns: the result of the method.
+        raise: Error if the method failed.
+        """
+        worker = self._idle.get()
+        try:
+            payload = worker.call(next(self._ids), method, params)
+        except Exception:
+            with self._lock:
+                self._workers.discard(worker)
+            worker.kill()
+            self._idle.put(self._spawn())
+            raise
+
+        self._idle.put(worker)
+        if RPC_ERROR in payload:
+            err = payload[RPC_ERROR]
+            raise Error(code=err.get(CODE),
+                        message=err.get(MESSAGE),
+                        data=err.get(DATA))
+        return payload.get(RESULT)
+
+    def close(self):
+        """Close stdin of all workers and wait for them to exit."""
+        with self._lock:
+            workers, self._workers = self._workers, set()
+        for worker in workers:
+            worker.close()
+
+
+class _ServeWorker(object):
+    """A single ``--jsh-serve`` process of a WorkerPool."""
+    def __init__(self, cmd, **kwargs):
+        import subprocess
+        from jshlib_process import PopenJsh
+        self.process = PopenJsh(args=[cmd, ARGV_JSH_SERVE],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                **kwargs)
+        self._responses = load_json_iter(self.process.stdout)
+
+    def call(self, request_id, method, params):
+        """Send a request and return its Response object."""
+        payload = RequestTemplate.get(method).encode(params, request_id)
+        self.process.stdin.write(payload.encode('utf-8'))
+        self.process.stdin.write(b'\n')
+        self.process.stdin.flush()
+
+        for value in self._responses:
+            if isinstance(value, dict) and value.get(ID) == request_id:
+                return value
+
+        raise Error(code=Error.INTERNAL_ERROR,
+                    message="jsh worker exited",
+                    data={'returncode': self.process.poll()})
+
+    def kill(self):
+        """Kill the process."""
+        self.process.kill()
+        self.process.wait()
+
+    def close(self):
+        """Close stdin and wait for the process to exit."""
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+def jsh_args(cmd, method, params=None):
+    """Construct the argv to call a jsh command with a request."""
+    reqstr = RequestTemplate.get(method).encode(params)
+    return [cmd, "{}={}".format(ARGV_JSH_REQUEST, reqstr)]
+
+
+class RequestTransport(object):
+    """The argv (and Popen kwargs) to call a jsh command with a request.
+
+    `transport` is one of:
+
+    - ``TRANSPORT_ARGV``: ``--jsh-request=<json>``, the same as `jsh_args`.
+    - ``TRANSPORT_FD``: ``--jsh-request-fd=<fd>``, an unlinked temporary file
+      inherited by the process (posix only).
+    - ``TRANSPORT_FILE``: ``--jsh-request-file=<path>``, a temporary file.
+    - None: argv if the request is at most REQUEST_ARGV_MAX bytes, otherwise
+      fd or file.
+
+    `framing` (one of FRAMINGS) asks the command to frame its stdout records
+    with ``--jsh-framing=<framing>``, see RecordWriter.
+
+    Call `started` once the process is started and `close` once it has
+    exited (PopenJsh does both).
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 cmd,
+                 method,
+                 params=None,
+                 transport=None,
+                 framing=None):
+        reqstr = RequestTemplate.get(method).encode(params)
+        if transport is None:
+            if len(reqstr) <= REQUEST_ARGV_MAX:
+                transport = TRANSPORT_ARGV
+            elif _HAS_PASS_FDS:
+                transport = TRANSPORT_FD
+            else:
+                transport = TRANSPORT_FILE
+
+        self.transport = transport
+        self.popen_kwargs = {}
+        self._file = None
+        self._path = None
+
+        if transport == TRANSPORT_ARGV:
+            arg = "{}={}".format(ARGV_JSH_REQUEST, reqstr)
+        elif transport == TRANSPORT_FD:
+            import tempfile
+            self._file = tempfile.TemporaryFile(prefix='jsh-request-')
+            self._file.write(reqstr.encode('utf-8'))
+            self._file.seek(0)
+            fd = self._file.fileno()
+            self.popen_kwargs['pass_fds'] = (fd, )
+            arg = "{}={}".format(ARGV_JSH_REQUEST_FD, fd)
+        elif transport == TRANSPORT_FILE:
+            import tempfile
+            with tempfile.NamedTemporaryFile(prefix='jsh-request-',
+                                             suffix='.json',
+                                             delete=False) as f:
+                self._path = f.name
+                f.write(reqstr.encode('utf-8'))
+            arg = "{}={}".format(ARGV_JSH_REQUEST_FILE, self._path)
+        else:
+            raise ValueError("Unknown transport: {}".format(transport))
+
+        self.args = [cmd, arg]
+        if framing not in (None, FRAMING_LINES):
+            if framing not in FRAMINGS:
+                raise ValueError("Unknown framing: {}".format(framing))
+            self.args.append("{}={}".format(ARGV_JSH_FRAMING, framing))
+
+    def started(self):
+        """The process was started: close the parent's copy of the fd."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        """The process has exited: remove any temporary file."""
+        self.started()
+        if self._path is not None:
+            _remove_quietly(self._path)
+            self._path = None
+
+
+def _iter_input_chunks(inputs):
+    """Encode the input values as newline separated utf-8 json, yielding
+    chunks of about CHUNK_SIZE bytes."""
+    if not inputs:
+        return
+
+    batch = []
+    size = 0
+    for value in inputs:
+        text = _CODEC.dumps(value)
+        batch.append(text)
+        size += len(text) + 1
+        if size >= CHUNK_SIZE:
+            batch.append('')
+            yield '\n'.join(batch).encode('utf-8')
+            batch = []
+            size = 0
+
+    if batch:
+        batch.append('')
+        yield '\n'.join(batch).encode('utf-8')
 
 
 def parse_jsh_argv(argv):
-    """Attempt to parse the argv for a ``--jsh-request=<json rpc>``
+    """Attempt to parse the argv for a ``--jsh-request=<json rpc>``.
 
-    returns: Request if the request exists, Error if it is an Error,
-      or None if --jsh-request does not exist.
-    raise: ValueError if the request is invalid.
+    The request can also be read from an inherited file descriptor with
+    ``--jsh-request-fd=<fd>`` or from a file with
+    ``--jsh-request-file=<path>``, see RequestTransport.
+
+    The stdout framing the requester asked for is returned by
+    `parse_jsh_framing`.
+
+    returns: Request if the request exists, Error if it is an Error, a list
+      of them for a batch, or None if --jsh-request does not exist.
+    raise: ValueError if the request is invalid or can not be read.
     """
     for arg in argv:
-        if arg.startswith(ARGV_JSH_REQUEST):
-            _, reqstr = arg.split('=', 1)
-            return parse_jsh_request(reqstr)
+        name, _, value = arg.partition('=')
+        if name == ARGV_JSH_REQUEST:
+            return parse_jsh_request(value)
+        if name in (ARGV_JSH_REQUEST_FD, ARGV_JSH_REQUEST_FILE):
+            return parse_jsh_request(_read_request(name, value))
 
     return None
 
 
+def parse_jsh_framing(argv):
+    """Return the stdout framing requested with ``--jsh-framing=<framing>``,
+    see RecordWriter.
+
+    It is FRAMING_LINES if there is none or it is unknown: the records are
+    then newline separated, which the requester reads as well. A command
+    applies it before writing any records::
+
+        jshlib.set_stdout_framing(jshlib.parse_jsh_framing(sys.argv))
+    """
+    framing = FRAMING_LINES
+    for arg in argv:
+        name, _, value = arg.partition('=')
+        if name == ARGV_JSH_FRAMING and value in FRAMINGS:
+            framing = value
+    return framing
+
+
+def _read_request(name, value):
+    """Read the request passed with ``--jsh-request-fd/file``."""
+    try:
+        if name == ARGV_JSH_REQUEST_FD:
+            f = io.open(int(value), 'rb')
+        else:
+            f = io.open(value, 'rb')
+        with f:
+            return f.read().decode('utf-8')
+    except (IOError, OSError) as e:
+        raise ValueError("Could not read {}={}: {}".format(name, value, e))
+
+
 def parse_jsh_request(reqstr):
     """Attempt to parse a string as a JSON-RPC object.
 
-    returns: Request if the request exists, Error if it is an Error.
+    returns: Request if the request exists, Error if it is an Error, or a
+      list of them if it is a batch (json array).
     raise: ValueError if the request is invalid.
     """
-    req = json.loads(reqstr)
+    req = _CODEC.loads(reqstr)
+    if isinstance(req, list):
+        if not req:
+            raise ValueError("Batch must not be empty")
+        return [_parse_jsh_obj(r) for r in req]
+    return _parse_jsh_obj(req)
+
+
+def _parse_jsh_obj(req):
+    """Parse an already loaded JSON-RPC object."""
+    if not isinstance(req, dict):
+        raise ValueError("JSON-RPC object must be an object: {}".format(
+            repr(req)))
+
     if METHOD in req:
         jsonrpc_value = req.get(JSONRPC, JSONRPC_VALUE)
         if jsonrpc_value != JSONRPC_VALUE:
             raise ValueError("Invalid jsonrpc value: {}".format(jsonrpc_value))
-        return Request(method=req[METHOD], params=req.get(PARAMS))
+        return Request(method=req[METHOD],
+                       params=req.get(PARAMS),
+                       id=req.get(ID))
 
     if CODE in req:
         code = req[CODE]
         if MESSAGE not in req:
-            raise ValueError("Error must have message: {}".format(
-                repr(reqstr)))
+            raise ValueError("Error must have message: {}".format(repr(req)))
         message = req[MESSAGE]
         data = req.get(DATA)
         return Error(code=code, message=message, data=data)
 
-    raise ValueError("Unknown json blob: {}".format(repr(reqstr)))
+    raise ValueError("Unknown json blob: {}".format(repr(req)))
+
 
+def serve(methods, stdin=None, stdout=None):
+    """Serve JSON-RPC requests with ``methods`` until stdin is closed.
 
-class Serializable:
-    """An object that can call serialize() to be json serializable."""
+    This is the ``--jsh-serve`` mode of a long-lived jsh process. Requests
+    (or batches of requests) are read from stdin a line at a time and
+    ``methods[method](params)`` is called for each one. The return value (or
+    raised Error) is written to stdout as a JSON-RPC Response with the
+    request's ``id``. Requests without an ``id`` are notifications and get no
+    response. A line which isn't json gets a PARSE_ERROR response and an
+    empty batch an INVALID_REQUEST one.
+
+    returns: 0, the return code of the process.
+    """
+    if stdin is None:
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    writer = RecordWriter(sys.stdout if stdout is None else stdout,
+                          always=True)
+    for line in stdin:
+        try:
+            objs = list(load_json_iter(line))
+        except ValueError as e:
+            err = Error(code=Error.PARSE_ERROR, message=str(e), data=None)
+            writer.write(error_response(err, None))
+            continue
+        for obj in objs:
+            for payload in _serve_obj(methods, obj):
+                writer.write(payload)
+    return 0
+
+
+def _serve_obj(methods, obj):
+    """Dispatch a request or batch read by `serve`, yielding the responses."""
+    if isinstance(obj, list) and not obj:
+        err = Error(code=Error.INVALID_REQUEST,
+                    message="Empty batch",
+                    data=None)
+        yield error_response(err, None)
+        return
+
+    for item in obj if isinstance(obj, list) else [obj]:
+        try:
+            req = _parse_jsh_obj(item)
+        except ValueError as e:
+            err = Error(code=Error.INVALID_REQUEST, message=str(e), data=None)
+            request_id = item.get(ID) if isinstance(item, dict) else None
+            payload = error_response(err, request_id)
+        else:
+            payload = dispatch(methods, req)
+
+        if payload is not None:
+            yield payload
+
+
+def dump_responses(methods, requests, ordered=True, max_workers=1,
+                   stdout=None):
+    """Dispatch a Request or batch of Requests, writing each Response to
+    stdout as soon as it is available.
+
+    With ``max_workers > 1`` the methods are called from a thread pool and the
+    Responses are written in the order of ``requests`` if ``ordered``, else
+    as they finish. Match them up with their ``id``.
+
+    returns: 0 if every method succeeded, else 1.
+    """
+    writer = RecordWriter(sys.stdout if stdout is None else stdout,
+                          always=True)
+    if not isinstance(requests, list):
+        requests = [requests]
+
+    if max_workers == 1:
+        payloads = (dispatch(methods, req) for req in requests)
+        return _write_responses(writer, payloads)
+
+    from concurrent import futures
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if ordered:
+            payloads = executor.map(lambda r: dispatch(methods, r), requests)
+        else:
+            payloads = (f.result() for f in futures.as_completed(
+                [executor.submit(dispatch, methods, r) for r in requests]))
+        return _write_responses(writer, payloads)
+
+
+def _write_responses(writer, payloads):
+    """Write the Responses, returning 1 if any of them is an error."""
+    rc = 0
+    for payload in payloads:
+        if payload is None:
+            continue
+        if RPC_ERROR in payload:
+            rc = 1
+        writer.write(payload)
+    return rc
+
+
+def dispatch(methods, req):
+    """Call ``methods[req.method](req.params)``.
+
+    returns: the JSON-RPC Response object, or None if ``req`` is a
+      notification (has no ``id``).
+    """
+    request_id = getattr(req, 'id', None)
+    try:
+        if not isinstance(req, Request):
+            raise Error(code=Error.INVALID_REQUEST,
+                        message="Expected a Request",
+                        data=req.serialize())
+        if req.method not in methods:
+            raise Error(code=Error.METHOD_NOT_FOUND,
+                        message="Method not found: {}".format(req.method),
+                        data=None)
+        result = methods[req.method](req.params)
+    except Error as e:
+        err = e
+    except Exception as e:  # pylint: disable=broad-except
+        err = Error.internal_exc(e)
+    else:
+        err = None
+
+    if request_id is None and isinstance(req, Request):
+        return None
+    if err is not None:
+        return error_response(err, request_id)
+    return response(result, request_id)
+
+
+class Serializable(object):
+    """An object that can call serialize() to be json serializable.
+
+    Serializable objects can be nested inside of other values which are
+    dumped.
+    """
+    __slots__ = ()
 
     # pylint: disable=no-self-use
     def serialize(self):
@@ -166,14 +1065,72 @@ class Serializable:
 
 
 class Request(Serializable):
-    """Standard JSON-RPC Request object."""
-    def __init__(self, method, params=None):
+    """Standard JSON-RPC Request object.
+
+    A Request without an ``id`` is a notification.
+    """
+    __slots__ = ('method', 'params', 'id')
+
+    # pylint: disable=redefined-builtin
+    def __init__(self, method, params=None, id=None):
         self.method = method
         self.params = params
+        self.id = id
 
     def serialize(self):
         """Convert to basic python types."""
-        return request(method=self.method, params=self.params)
+        return request(method=self.method, params=self.params, id=self.id)
+
+    def encode(self):
+        """Encode to json text, see RequestTemplate."""
+        return RequestTemplate.get(self.method).encode(self.params, self.id)
+
+
+class RequestTemplate(object):
+    """Encode Requests for a method, with the fixed ``jsonrpc`` and ``method``
+    members encoded once so that only ``params`` and ``id`` are encoded per
+    call.
+
+    The text is the same as ``codec.dumps(request(method, params, id))``: all
+    of it is encoded with ``codec`` (the current Codec by default) and its
+    separators. Use `get` for the shared template of a method.
+    """
+    __slots__ = ('method', 'codec', '_head', '_params', '_id')
+
+    def __init__(self, method, codec=None):
+        self.method = method
+        self.codec = codec = codec or _CODEC
+        self._head = codec.dumps(request(method))[:-1]
+        # the item and key separators of the codec
+        sample = codec.dumps({"a": 0, "b": 0})
+        key_sep = sample[len('{"a"'):sample.index('0')]
+        item_sep = sample[sample.index('0') + 1:sample.index('"b"')]
+        self._params = '{}"{}"{}'.format(item_sep, PARAMS, key_sep)
+        self._id = '{}"{}"{}'.format(item_sep, ID, key_sep)
+
+    @classmethod
+    def get(cls, method):
+        """The template of ``method`` for the current Codec, cached for the
+        most recent methods."""
+        template = _REQUEST_TEMPLATES.get(method)
+        if template is None or template.codec is not _CODEC:
+            if len(_REQUEST_TEMPLATES) >= 1024:
+                _REQUEST_TEMPLATES.clear()
+            template = _REQUEST_TEMPLATES[method] = cls(method)
+        return template
+
+    def encode(self, params=None, id=None):  # pylint: disable=redefined-builtin
+        """The json text of ``request(method, params, id)``."""
+        text = self._head
+        if params:
+            text += self._params + self.codec.dumps(params)
+        if id is not None:
+            # ints (not bools) are the common ids, and cheap to encode
+            if type(id) is int:  # pylint: disable=unidiomatic-typecheck
+                text += self._id + str(id)
+            else:
+                text += self._id + self.codec.dumps(id)
+        return text + '}'
 
 
 class Error(Exception, Serializable):
@@ -186,6 +1143,10 @@ class Error(Exception, Serializable):
     METHOD_NOT_FOUND = -32601
     INVALID_PARAMS = -32602
     INTERNAL_ERROR = -32603
+    # a jsh process was killed for exceeding a limit, see PopenJsh
+    LIMIT_EXCEEDED = -32001
+
+    __slots__ = ('code', 'message', 'data')
 
     def __init__(self, code, message, data):
         super(Error, self).__init__(message)
@@ -193,6 +1154,9 @@ class Error(Exception, Serializable):
         self.message = message
         self.data = data
 
+    def __reduce__(self):
+        return (type(self), (self.code, self.message, self.data))
+
     @classmethod
     def internal_exc(cls, exc, tb=True):
         """Create an internal error, possibly from another exc.
@@ -202,6 +1166,7 @@ class Error(Exception, Serializable):
         data = None
         message = repr(exc)
         if tb:
+            import traceback
             data = traceback.format_exc().split('\n')
         return cls(code=cls.INTERNAL_ERROR, message=message, data=data)
 
@@ -209,7 +1174,187 @@ class Error(Exception, Serializable):
         return error(code=self.code, message=self.message, data=self.data)
 
 
-def request(method, params=None):
+class LogRecord(Serializable):
+    """A log record which serializes to `log_payload`.
+
+    It is smaller than the dict for keeping many records in memory.
+    """
+    __slots__ = ('msg', 'lvl', 'data')
+
+    def __init__(self, msg, lvl=None, data=None):
+        self.msg = msg
+        self.lvl = ERROR if lvl is None else lvl
+        self.data = data
+
+    def serialize(self):
+        return log_payload(self.msg, lvl=self.lvl, data=self.data)
+
+
+def _serialize_default(obj):
+    """json ``default`` hook for nested Serializable objects."""
+    if isinstance(obj, Serializable):
+        return obj.serialize()
+    raise TypeError("Object of type {} is not JSON serializable".format(
+        type(obj).__name__))
+
+
+_JSON_DUMPS = json.JSONEncoder(default=_serialize_default).encode
+
+
+class Codec(object):
+    """A json backend used for all encoding and decoding in jshlib.
+
+    - ``loads(text)``: decode a single json value from str or bytes.
+    - ``dumps(obj)``: encode a value (which may contain Serializable objects)
+      to a str.
+
+    Backends may format their output differently, i.e. ``orjson`` does not
+    add spaces after separators and encodes ``NaN`` as ``null``. Values which
+    a backend cannot encode (i.e. integers too large for ``orjson``) fall back
+    to the stdlib ``json`` module.
+    """
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return "Codec({!r})".format(self.name)
+
+
+def load_codec(name):
+    """Load the named json backend (one of CODEC_NAMES).
+
+    raise: ImportError if it is not installed, ValueError if it is unknown.
+    """
+    # pylint: disable=import-outside-toplevel
+    if name == 'json':
+        return Codec('json', json.loads, _JSON_DUMPS)
+
+    if name == 'orjson':
+        import orjson
+
+        def orjson_dumps(obj):
+            try:
+                return orjson.dumps(obj,
+                                    default=_serialize_default,
+                                    option=orjson.OPT_NON_STR_KEYS).decode()
+            except TypeError:
+                return _JSON_DUMPS(obj)
+
+        return Codec(name, orjson.loads, orjson_dumps)
+
+    if name == 'ujson':
+        import ujson
+
+        def ujson_dumps(obj):
+            try:
+                return ujson.dumps(obj,
+                                   default=_serialize_default,
+                                   escape_forward_slashes=False)
+            except (TypeError, OverflowError):
+                return _JSON_DUMPS(obj)
+
+        return Codec(name, ujson.loads, ujson_dumps)
+
+    if name == 'rapidjson':
+        import rapidjson
+
+        def rapidjson_loads(text):
+            return rapidjson.loads(text, number_mode=rapidjson.NM_NAN)
+
+        def rapidjson_dumps(obj):
+            return rapidjson.dumps(obj,
+                                   default=_serialize_default,
+                                   number_mode=rapidjson.NM_NAN)
+
+        return Codec(name, rapidjson_loads, rapidjson_dumps)
+
+    raise ValueError("Unknown json codec {!r}, expected one of {}".format(
+        name, CODEC_NAMES))
+
+
+def available_codecs():
+    """The names of the json backends which are installed, fastest first."""
+    names = []
+    for name in CODEC_NAMES:
+        try:
+            load_codec(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def get_codec():
+    """The Codec currently used by jshlib."""
+    return _CODEC
+
+
+def set_codec(name=None):
+    """Select the json backend used by jshlib and return its Codec.
+
+    If ``name`` is None the backend is taken from the ``JSH_JSON_CODEC``
+    environment variable, else the fastest installed one is used. It is
+    imported when it is first used.
+
+    raise: ImportError if the requested backend is not installed.
+    """
+    global _CODEC  # pylint: disable=global-statement
+    if name is None:
+        name = os.environ.get(JSON_CODEC_ENV)
+    if name:
+        _CODEC = load_codec(name)
+        return _CODEC
+
+    for name in CODEC_NAMES:
+        if name == 'json':
+            _CODEC = load_codec(name)
+        elif _is_installed(name):
+            _CODEC = _lazy_codec(name)
+        else:
+            continue
+        return _CODEC
+    raise ImportError("no json codec")  # json is always available
+
+
+def _is_installed(name):
+    """Whether a module can be imported, without importing it."""
+    from importlib.util import find_spec
+    return find_spec(name) is not None
+
+
+def _lazy_codec(name):
+    """A Codec which imports its backend when it is first used, falling back
+    to ``json`` if that fails."""
+    codec = Codec(name, None, None)
+
+    def load():
+        try:
+            loaded = load_codec(name)
+        except ImportError:
+            loaded = load_codec('json')
+        codec.name = loaded.name
+        codec.loads = loaded.loads
+        codec.dumps = loaded.dumps
+
+    def loads(text):
+        load()
+        return codec.loads(text)
+
+    def dumps(obj):
+        load()
+        return codec.dumps(obj)
+
+    codec.loads = loads
+    codec.dumps = dumps
+    return codec
+
+
+_CODEC = set_codec()
+
+
+def request(method, params=None, id=None):  # pylint: disable=redefined-builtin
     """Create a standard JSON-RPC Request object."""
     payload = {
         JSONRPC: "2.0",
@@ -219,9 +1364,23 @@ def request(method, params=None):
     if params:
         payload["params"] = params
 
+    if id is not None:
+        payload[ID] = id
+
     return payload
 
 
+def request_batch(requests):
+    """Create a JSON-RPC batch (list of Request objects).
+
+    Each item can be a Request or a ``(method[, params[, id]])`` tuple.
+    """
+    return [
+        r.serialize() if isinstance(r, Request) else request(*r)
+        for r in requests
+    ]
+
+
 def error(code, message, data=None):
     """Create a standard JSON-RPC Error object."""
     return {
@@ -231,6 +1390,26 @@ def error(code, message, data=None):
     }
 
 
+def response(result, request_id):
+    """Create a standard JSON-RPC Response object."""
+    return {
+        JSONRPC: JSONRPC_VALUE,
+        RESULT: result,
+        ID: request_id,
+    }
+
+
+def error_response(err, request_id):
+    """Create a standard JSON-RPC Response object for an Error."""
+    if isinstance(err, Serializable):
+        err = err.serialize()
+    return {
+        JSONRPC: JSONRPC_VALUE,
+        RPC_ERROR: err,
+        ID: request_id,
+    }
+
+
 def log(msg, lvl=ERROR):
     """Log the message at appropriate lvl to stderr and return the object."""
     payload = log_payload(msg, lvl=lvl)
@@ -248,116 +1427,1055 @@ def log_payload(msg, lvl=None, data=None):
 
 
 def dump_stdout(payload):
-    """Dump a python object to stdout as json with a newline."""
-    if isinstance(payload, Serializable):
-        payload = payload.serialize()
-    sys.stdout.write(json.dumps(payload))
-    sys.stdout.write('\n')
+    """Dump a python object to stdout as json with a newline.
+
+    Records are buffered by `stdout_writer` and flushed at exit. Flush it
+    before writing to ``sys.stdout`` directly.
+    """
+    stdout_writer().write(payload)
 
 
 def dump_stderr(payload):
     """Dump a python object to stderr as json with a newline."""
-    if isinstance(payload, Serializable):
-        payload = payload.serialize()
-    sys.stderr.write(json.dumps(payload))
-    sys.stderr.write('\n')
+    stderr_writer().write(payload)
+
+
+def stdout_writer():
+    """The RecordWriter for the current ``sys.stdout``.
+
+    It flushes every record if stdout is a terminal, else every CHUNK_SIZE
+    characters.
+    """
+    return _std_writer('stdout')
+
+
+def stderr_writer():
+    """The RecordWriter for the current ``sys.stderr``.
+
+    It flushes every record so that logs are seen immediately.
+    """
+    return _std_writer('stderr', always=True)
 
 
-def load_json_iter(stream):
+def set_stdout_framing(framing):
+    """Set the framing of `stdout_writer` records, see RecordWriter.
+
+    Records which were already written are flushed first.
+    """
+    global _STDOUT_FRAMING  # pylint: disable=global-statement
+    if framing not in FRAMINGS:
+        raise ValueError("Unknown framing: {}".format(framing))
+    _STDOUT_FRAMING = framing
+    writer = _STD_WRITERS.pop('stdout', None)
+    if writer is not None:
+        _flush_quietly(writer)
+
+
+def _std_writer(name, always=False):
+    """Get the writer for ``sys.<name>``, replacing it if the stream was."""
+    stream = getattr(sys, name)
+    writer = _STD_WRITERS.get(name)
+    if writer is None or writer.stream is not stream:
+        if writer is not None:
+            _flush_quietly(writer)
+        framing = _STDOUT_FRAMING if name == 'stdout' else FRAMING_LINES
+        writer = RecordWriter(stream,
+                              always=always or _isatty(stream),
+                              framing=framing)
+        _STD_WRITERS[name] = writer
+    return writer
+
+
+def _isatty(stream):
+    try:
+        return stream.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+
+def _flush_quietly(writer):
+    """Flush a writer whose stream may already be closed."""
+    try:
+        writer.flush()
+    except (OSError, ValueError):
+        pass
+
+
+@atexit.register
+def _flush_std_writers():
+    for writer in list(_STD_WRITERS.values()):
+        _flush_quietly(writer)
+
+
+class RecordWriter(object):
+    """Buffered writer of newline separated json records.
+
+    Records are encoded into a buffer which is written to ``stream`` (text or
+    binary) with a single write when any of these limits is reached:
+
+    - ``max_bytes``: the size of the buffered records.
+    - ``max_records``: the number of buffered records.
+    - ``max_delay``: seconds since the oldest buffered record was written.
+      This is only checked when writing, there is no background thread.
+    - ``always``: flush after every write, for interactive use.
+
+    ``framing`` is one of:
+
+    - ``FRAMING_LINES``: a newline after each record.
+    - ``FRAMING_NETSTRING``: each record is a netstring of its utf-8 json,
+      ``<length>:<json>,``, so that a reader can slice out records without
+      scanning them. JsonStreamParser detects it from the first record.
+
+    Call `flush` (or use it as a context manager) when done.
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self,
+                 stream,
+                 max_bytes=CHUNK_SIZE,
+                 max_records=None,
+                 max_delay=None,
+                 always=False,
+                 framing=FRAMING_LINES):
+        if framing not in FRAMINGS:
+            raise ValueError("Unknown framing: {}".format(framing))
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.max_delay = max_delay
+        self.always = always
+        self.framing = framing
+        self._netstring = framing == FRAMING_NETSTRING
+        self._binary = isinstance(stream, (io.RawIOBase, io.BufferedIOBase))
+        self._max_bytes = _INF if max_bytes is None else max_bytes
+        self._max_records = _INF if max_records is None else max_records
+        self._lock = _thread.allocate_lock()
+        self._buf = []
+        self._size = 0
+        self._records = 0
+        self._since = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def write(self, payload):
+        """Write a python object (or Serializable) as a json record."""
+        if type(payload) is Request:  # pylint: disable=unidiomatic-typecheck
+            text = payload.encode()
+        else:
+            text = _CODEC.dumps(payload)
+        if self._netstring:
+            text = _netstring(text)
+        else:
+            text += '\n'
+        self._append(text, 1)
+
+    def write_many(self, payloads, batch_size=1024):
+        """Write many python objects, encoding them in batches."""
+        payloads = iter(payloads)
+        while True:
+            batch = list(itertools.islice(payloads, batch_size))
+            if not batch:
+                return
+            if self._netstring:
+                text = ''.join(map(_netstring, map(_CODEC.dumps, batch)))
+            else:
+                text = '\n'.join(map(_CODEC.dumps, batch)) + '\n'
+            self._append(text, len(batch))
+
+    def flush(self):
+        """Write the buffered records and flush the stream."""
+        with self._lock:
+            self._flush()
+
+    def _append(self, text, records):
+        with self._lock:
+            self._buf.append(text)
+            self._size += len(text)
+            self._records += records
+            if (self.always or self._size >= self._max_bytes
+                    or self._records >= self._max_records
+                    or (self.max_delay is not None and self._is_late())):
+                self._flush()
+
+    def _is_late(self):
+        now = time.monotonic()
+        if self._since is None:
+            self._since = now
+        return now - self._since >= self.max_delay
+
+    def _flush(self):
+        if self._buf:
+            data = ''.join(self._buf)
+            self._buf = []
+            self._size = 0
+            self._records = 0
+            self._since = None
+            self.stream.write(data.encode('utf-8') if self._binary else data)
+        self.stream.flush()
+
+
+def _netstring(text):
+    """Frame json text as a netstring of its utf-8 bytes."""
+    return '{}:{},'.format(len(text.encode('utf-8')), text)
+
+
+# pylint: disable=too-many-arguments
+def load_json_iter(stream,
+                   fields=None,
+                   where=None,
+                   stats=None,
+                   workers=None,
+                   framing=FRAMING_LINES):
     """Iteratively load json objects from a stream.
+
+    ``stream`` can be any of:
+
+    - a string of json text.
+    - ``bytes``, ``bytearray`` or ``memoryview`` of utf-8 json text.
+    - a path (``pathlib.Path`` or other ``os.PathLike``), which is scanned
+      through ``mmap`` without reading the whole file.
+    - a text or binary file-like object (i.e. ``sys.stdin.buffer``).
+    - any iterable of text or bytes chunks (i.e. lines).
+
+    Records are found by a JsonStreamParser on large buffered chunks, so bare
+    numbers, strings, lists and objects may be separated by any whitespace.
+    If ``framing`` is FRAMING_NETSTRING, netstring framed records (see
+    RecordWriter) are read as well.
+    Binary input is decoded a chunk at a time, so peak memory is bounded by
+    the largest record rather than the whole stream.
+
+    Text pipes and terminals are read a line at a time so that records are
+    yielded as soon as they are available.
+
+    ``fields`` is a list of keys: object records are reduced to only those
+    keys. ``where`` is a predicate: a callable of the record or a dict of
+    ``{key: value}`` (or ``{key: set_of_values}``) which object records must
+    match. Records which don't match are skipped, see `JsonStreamParser`.
+
+    ``stats`` can be a StreamStats which counts the records, bytes and time.
+
+    ``workers`` decodes newline delimited json on that many processes, see
+    `parallel_load`.
     """
+    if workers is not None and workers != 1:
+        if framing != FRAMING_LINES:
+            raise ValueError("workers only load newline delimited json")
+        return parallel_load(stream,
+                             workers,
+                             fields=fields,
+                             where=where,
+                             stats=stats)
     if isinstance(stream, str):
-        stream = io.StringIO(stream)
-
-    for slist in _load_json_striter(stream):
-        valuestr = ''.join(slist)
-        value = json.loads(valuestr)
-        yield value
-
-
-# pylint: disable=too-many-statements
-# pylint: disable=too-many-branches
-def _load_json_striter(stream):
-    """Load jsh strings from a stream."""
-    alltext = []
-
-    ignore_next = False
-    open_curly = False
-    open_bracket = False
-    open_string = False
-    is_digits = False
-    brackets = 0
-
-    def consolodate_result(alltext, text, i):
-        """Consolodate the result into alltext and return what was excluded."""
-        include, text = text[:i + 1], text[i + 1:]
-        alltext.append(include)
-        return text, 0
-
-    for text in stream:
-        i = 0
-        while i < len(text):
-            c = text[i]
-
-            if ignore_next:
-                ignore_next = False
-            elif c == '\\':
-                ignore_next = True
-            elif is_digits is True and c not in _DIGITS:
-                # We found a Number
-                text, i = consolodate_result(alltext, text, i)
-                yield alltext
-                alltext = []
-                is_digits = False
-                continue
-            elif c == '"':
-                if not (open_curly or open_bracket):
-                    if open_string:
-                        # We found a String
-                        text, i = consolodate_result(alltext, text, i)
-                        yield alltext
-                        alltext = []
-                        open_string = False
+        chunks = [stream]
+    elif isinstance(stream, _BYTES_TYPES):
+        chunks = _iter_view(memoryview(stream).cast('B'))
+    elif isinstance(stream, _PATH_TYPES):
+        chunks = _iter_mmap(stream)
+    elif isinstance(stream, (io.RawIOBase, io.BufferedIOBase)):
+        read = getattr(stream, 'read1', stream.read)
+        chunks = iter(functools.partial(read, CHUNK_SIZE), b'')
+    elif _is_seekable(stream):
+        chunks = iter(functools.partial(stream.read, CHUNK_SIZE), '')
+    else:
+        chunks = stream
+
+    return itertools.chain.from_iterable(
+        _load_json_striter(chunks, fields, where, stats, framing))
+
+
+def parallel_load(stream,
+                  workers=None,
+                  ordered=True,
+                  fields=None,
+                  where=None,
+                  chunk_size=PARALLEL_CHUNK_SIZE,
+                  stats=None):
+    """Decode newline delimited json on ``workers`` processes (default: the
+    number of cpus).
+
+    ``stream`` is a path, a string, bytes-like or a file. It is split
+    on newlines into chunks of about ``chunk_size`` bytes, so a record must
+    not span lines (records written by `dump_stdout` never do). The workers
+    read the chunks of a path themselves.
+
+    Yields the records in the order of the stream, or chunk by chunk as they
+    are decoded if not ``ordered``. ``fields`` and ``where`` are the same as
+    for `load_json_iter`, a callable ``where`` must be picklable. Input of a
+    single chunk is decoded in this process.
+
+    ``stats`` can be a StreamStats which counts the records and (utf-8)
+    bytes, ``parse_s`` is the time spent waiting for the chunks.
+
+    raise: JsonStreamError with the offset in bytes from the start of the
+      stream.
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    from concurrent import futures
+    workers = workers or os.cpu_count() or 1
+
+    def check(result, offset, nbytes, start):
+        values = _check_chunk(result, offset)
+        if stats is not None:
+            stats.add(nbytes, len(values), start)
+        return values
+
+    chunks = _iter_line_chunks(stream, chunk_size)
+    first = list(itertools.islice(chunks, 2))
+    if workers == 1 or len(first) < 2:
+        for offset, chunk in itertools.chain(first, chunks):
+            start = time.monotonic()
+            for value in check(_load_chunk(chunk, fields, where), offset,
+                               _chunk_bytes(chunk), start):
+                yield value
+        return
+
+    window = 2 * workers
+    chunks = enumerate(itertools.chain(first, chunks))
+    running = {}
+    finished = {}
+    next_index = 0
+
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                for index, (offset, chunk) in itertools.islice(
+                        chunks, window - len(running) - len(finished)):
+                    future = executor.submit(_load_chunk, chunk, fields,
+                                             where)
+                    running[future] = (index, offset, _chunk_bytes(chunk))
+                if not running:
+                    return
+
+                start = time.monotonic()
+                done, _ = futures.wait(running,
+                                       return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    index, offset, nbytes = running.pop(future)
+                    if not ordered:
+                        for value in check(future.result(), offset, nbytes,
+                                           start):
+                            yield value
+                        start = time.monotonic()
                         continue
 
-                open_string = not open_string
-
-            elif c in _DIGITS and not (open_string or open_bracket
-                                       or open_curly):
-                is_digits = True
-
-            elif c in _BRACKET and not (open_string or open_curly):
-                if c == '[':
-                    open_bracket = True
-                    brackets += 1
-                elif c == ']':
-                    brackets -= 1
-                    if brackets == 0:
-                        # We found a List
-                        text, i = consolodate_result(alltext, text, i)
-                        yield alltext
-                        alltext = []
-                        open_bracket = False
-                        continue
+                    finished[index] = (future.result(), offset, nbytes)
+                    while next_index in finished:
+                        result, offset, nbytes = finished.pop(next_index)
+                        for value in check(result, offset, nbytes, start):
+                            yield value
+                        start = time.monotonic()
+                        next_index += 1
+        finally:
+            for future in running:
+                future.cancel()
+
+
+def _iter_line_chunks(stream, size):
+    """Split a parallel_load stream on newlines into (offset, chunk).
+
+    The chunk of a path is ``(path, start, end)``, else it is bytes. Text is
+    encoded to utf-8, so the offsets are in bytes.
+    """
+    if isinstance(stream, str):
+        stream = stream.encode('utf-8')
+    elif isinstance(stream, memoryview):
+        stream = stream.tobytes()
+
+    if isinstance(stream, (bytes, bytearray)):
+        start = 0
+        while start < len(stream):
+            end = stream.find(b'\n', start + size) + 1 or len(stream)
+            yield start, bytes(stream[start:end])
+            start = end
+    elif isinstance(stream, _PATH_TYPES):
+        import mmap
+        path = os.fspath(stream)
+        with open(path, 'rb') as f:
+            total = os.fstat(f.fileno()).st_size
+            if not total:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = 0
+                while start < total:
+                    end = mm.find(b'\n', start + size) + 1 or total
+                    yield start, (path, start, end)
+                    start = end
+            finally:
+                mm.close()
+    else:
+        offset = 0
+        while True:
+            chunk = stream.read(size)
+            if not chunk:
+                return
+            if isinstance(chunk, str):
+                if not chunk.endswith('\n'):
+                    chunk += stream.readline()
+                chunk = chunk.encode('utf-8')
+            elif not chunk.endswith(b'\n'):
+                chunk += stream.readline()
+            yield offset, chunk
+            offset += len(chunk)
+
+
+def _chunk_bytes(chunk):
+    """The size of a chunk of parallel_load."""
+    if isinstance(chunk, tuple):
+        return chunk[2] - chunk[1]
+    return len(chunk)
+
+
+def _load_chunk(chunk, fields, where):
+    """Decode a chunk of parallel_load, in a worker process.
+
+    returns: (values, None), or (None, (msg, offset)) if it is invalid.
+    """
+    if isinstance(chunk, tuple):
+        path, start, end = chunk
+        with open(path, 'rb') as f:
+            f.seek(start)
+            chunk = f.read(end - start)
+    try:
+        return list(load_json_iter(chunk, fields, where)), None
+    except JsonStreamError as e:
+        return None, (e.msg, e.offset)
+
+
+def _check_chunk(result, offset):
+    """The values of a decoded chunk, raising its error."""
+    values, error = result
+    if error is not None:
+        raise JsonStreamError(error[0], offset + error[1])
+    return values
+
+
+def _is_seekable(stream):
+    """Whether the stream is an in-memory or on-disk file."""
+    try:
+        return stream.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+def _iter_view(view):
+    """Iterate over CHUNK_SIZE slices of a memoryview without copying."""
+    for start in range(0, len(view), CHUNK_SIZE):
+        yield view[start:start + CHUNK_SIZE]
+
+
+def _iter_mmap(path):
+    """Iterate over CHUNK_SIZE byte chunks of a memory mapped file."""
+    import mmap
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start in range(0, len(mm), CHUNK_SIZE):
+                yield mm[start:start + CHUNK_SIZE]
+        finally:
+            mm.close()
+
+
+def _load_json_striter(chunks,
+                       fields=None,
+                       where=None,
+                       stats=None,
+                       framing=FRAMING_LINES):
+    """Load lists of json values from an iterable of text or byte chunks."""
+    parser = JsonStreamParser(fields, where, stats, framing)
+    for chunk in chunks:
+        values = parser.feed(chunk)
+        if values:
+            yield values
+
+    values = parser.close()
+    if values:
+        yield values
+
+
+class JsonStreamError(ValueError):
+    """Invalid json in a stream.
+
+    ``offset`` is the position of the error from the start of the stream, in
+    bytes if the parser was fed bytes, else in characters.
+    """
+    def __init__(self, msg, offset):
+        super(JsonStreamError, self).__init__("{} at offset {}".format(
+            msg, offset))
+        self.msg = msg
+        self.offset = offset
+
+
+class CallStats(Serializable):
+    """Timings and counters of a jsh process, see `PopenJsh.run_jsh`.
+
+    - ``spawn_s``: seconds to start the process (fork and exec).
+    - ``wall_s``: seconds from starting the process until it was waited on.
+    - ``user_s``, ``sys_s``, ``max_rss_kb``: the CPU time and peak memory of
+      the process, from its rusage (posix only).
+    - ``streams``: the StreamStats of its ``OUT`` and ``LOG`` records.
+
+    Values which weren't measured are None.
+    """
+    def __init__(self, log=False):
+        self.log = log
+        self.cmd = None
+        self.method = None
+        self.returncode = None
+        self.spawn_s = None
+        self.wall_s = None
+        self.user_s = None
+        self.sys_s = None
+        self.max_rss_kb = None
+        self.streams = {OUT: StreamStats(), LOG: StreamStats()}
+        self._start = None
+
+    def started(self, cmd, method, start):
+        """The process was started, its Popen was created at ``start``."""
+        now = time.monotonic()
+        self.cmd = cmd
+        self.method = method
+        self.spawn_s = now - start
+        self._start = start
+        for stream in self.streams.values():
+            stream.start = start
+
+    def rusage(self, rusage):
+        """Record the ``resource.struct_rusage`` of the exited process."""
+        self.user_s = rusage.ru_utime
+        self.sys_s = rusage.ru_stime
+        # kilobytes on linux, bytes on macos
+        self.max_rss_kb = rusage.ru_maxrss
+        if sys.platform == 'darwin':
+            self.max_rss_kb //= 1024
+
+    def exited(self, returncode):
+        """The process was waited on, write the stats if ``log``."""
+        self.returncode = returncode
+        if self._start is not None:
+            self.wall_s = time.monotonic() - self._start
+        if self.log:
+            dump_stderr(log_payload("jsh call stats", lvl=INFO, data=self))
+
+    def serialize(self):
+        return {
+            'cmd': self.cmd,
+            'method': self.method,
+            'returncode': self.returncode,
+            'spawn_s': self.spawn_s,
+            'wall_s': self.wall_s,
+            'user_s': self.user_s,
+            'sys_s': self.sys_s,
+            'max_rss_kb': self.max_rss_kb,
+            'streams': {k: v.serialize()
+                        for k, v in self.streams.items()},
+        }
+
+
+class StreamStats(Serializable):
+    """Counters of a stream of json records, see `JsonStreamParser`.
+
+    - ``bytes`` and ``records``: the amount read (characters for text).
+    - ``parse_s``: seconds spent decoding.
+    - ``wall_s``: seconds from ``start`` to the last data.
+    - ``first_record_s``: seconds from ``start`` to the first record, or
+      None.
+
+    ``start`` is when the stats are created, or when the process started for
+    the streams of a CallStats.
+    """
+    def __init__(self):
+        self.start = time.monotonic()
+        self.bytes = 0
+        self.records = 0
+        self.parse_s = 0.0
+        self.wall_s = 0.0
+        self.first_record_s = None
+
+    def add(self, nbytes, records, start):
+        """Count data which was parsed from ``start`` until now."""
+        now = time.monotonic()
+        self.bytes += nbytes
+        self.records += records
+        self.parse_s += now - start
+        self.wall_s = now - self.start
+        if records and self.first_record_s is None:
+            self.first_record_s = now - self.start
+
+    @property
+    def records_per_s(self):
+        return self.records / self.wall_s if self.wall_s else 0.0
+
+    @property
+    def bytes_per_s(self):
+        return self.bytes / self.wall_s if self.wall_s else 0.0
+
+    def serialize(self):
+        return {
+            'bytes': self.bytes,
+            'records': self.records,
+            'parse_s': self.parse_s,
+            'wall_s': self.wall_s,
+            'first_record_s': self.first_record_s,
+            'records_per_s': self.records_per_s,
+            'bytes_per_s': self.bytes_per_s,
+        }
+
+
+class JsonStreamParser(object):
+    """Push-style incremental parser for a stream of json values.
+
+    Use `feed` with text or utf-8 bytes chunks, split at any point (even
+    inside of a record or a utf-8 character), and it returns the values
+    which were completed. This makes it suitable for selector loops, sockets
+    and asyncio protocols.
+
+    The complete values in a chunk are decoded in bulk by the codec. The
+    partial value at the end of a chunk is tracked by a small state machine
+    which only looks at the new data, so a large record is never rescanned
+    as more of it arrives and is decoded once when it is complete.
+
+    ``framing`` is the framing the stream was requested with. If it is
+    FRAMING_NETSTRING and the stream starts with a netstring length
+    (``<digits>:``, which is not valid json) the records are netstring
+    framed, see RecordWriter. Each one is sliced out by its length and
+    decoded without being scanned. Otherwise (i.e. the command doesn't
+    support the framing) the records are json text.
+
+    ``fields`` and ``where`` project and filter the values, see
+    `load_json_iter`. When ``where`` is a dict of strings, a line of
+    newline-delimited json which can't contain the values (and has no
+    escapes) is skipped without being decoded or validated.
+
+    ``stats`` can be a StreamStats which is updated by each call.
+    """
+    def __init__(self,
+                 fields=None,
+                 where=None,
+                 stats=None,
+                 framing=FRAMING_LINES):
+        if framing not in FRAMINGS:
+            raise ValueError("Unknown framing: {}".format(framing))
+        # None until the start of a netstring stream is sniffed
+        self._framing = None if framing == FRAMING_NETSTRING else FRAMING_LINES
+        self._head = None
+        self._frames = None
+        self._decoder = None
+        self._binary = None
+        self._parts = []
+        self._tracker = None
+        self._offset = 0
+        self._filter = None
+        self._skip = None
+        self.stats = stats
+        if fields is not None or where is not None:
+            self._filter = _RecordFilter(fields, where)
+            self._skip = self._filter.skip_line
+
+    def feed(self, data):
+        """Add text or bytes and return the list of values they completed.
+
+        raise: JsonStreamError if a completed value is invalid.
+        """
+        if self.stats is None:
+            return self._feed(data)
+        start = time.monotonic()
+        values = self._feed(data)
+        self.stats.add(len(data), len(values), start)
+        return values
+
+    def _feed(self, data):
+        if self._framing is not FRAMING_LINES:
+            if self._framing is None:
+                data = self._sniff(data)
+                if data is None:
+                    return []
+            if self._framing is FRAMING_NETSTRING:
+                return self._feed_frames(data)
+        if isinstance(data, _BYTES_TYPES):
+            if self._decoder is None:
+                self._decoder = codecs.getincrementaldecoder('utf-8')()
+            if self._binary is None:
+                self._binary = True
+            data = self._decoder.decode(data)
+        elif self._binary is None:
+            self._binary = False
+        values = self._feed_text(data)
+        if self._filter is None:
+            return values
+        return self._filter.apply(values)
+
+    def close(self):
+        """Return the remaining values, the stream is done.
+
+        raise: JsonStreamError if the remaining data is not valid json.
+        """
+        if self.stats is None:
+            return self._close()
+        start = time.monotonic()
+        values = self._close()
+        self.stats.add(0, len(values), start)
+        return values
+
+    def _close(self):
+        values = []
+        if self._framing is None and self._head is not None:
+            # only digits, i.e. a bare number
+            self._framing = FRAMING_LINES
+            head, self._head = self._head, None
+            values = self._feed(head)
+        if self._framing is FRAMING_NETSTRING:
+            if self._frames:
+                raise JsonStreamError("Truncated netstring", self._offset)
+            return values
+
+        rest = []
+        if self._decoder is not None:
+            rest = self._feed_text(self._decoder.decode(b'', final=True))
+        if self._tracker is not None:
+            rest.append(self._decode_parts())
+        if self._filter is not None:
+            rest = self._filter.apply(rest)
+        return values + rest
+
+    def _sniff(self, data):
+        """Detect the framing from the start of the stream.
+
+        returns: the data buffered so far once the framing is known, else
+          None.
+        """
+        if self._head is not None:
+            data = self._head + data
+        start = data[:_FRAME_HEAD_MAX + 1]
+        if not isinstance(start, str):
+            start = bytes(start).decode('latin-1')
+        digits = len(start) - len(start.lstrip('0123456789'))
+        if digits == len(start) and digits <= _FRAME_HEAD_MAX:
+            self._head = data if isinstance(data, (str, bytes)) else bytes(data)
+            return None
+
+        self._head = None
+        if digits and start[digits:digits + 1] == ':':
+            self._framing = FRAMING_NETSTRING
+            self._frames = bytearray()
+        else:
+            self._framing = FRAMING_LINES
+        return data
+
+    def _feed_frames(self, data):
+        """Slice the complete netstrings out of the buffered data."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        buf = self._frames
+        buf += data
+        values = []
+        loads = _CODEC.loads
+        skip = self._skip
+        pos = 0
+        while True:
+            colon = buf.find(b':', pos, pos + _FRAME_HEAD_MAX + 1)
+            if colon < 0:
+                if len(buf) - pos > _FRAME_HEAD_MAX:
+                    raise JsonStreamError("Invalid netstring length",
+                                          self._offset + pos)
+                break
+            size = buf[pos:colon]
+            if not size.isdigit():
+                raise JsonStreamError("Invalid netstring length",
+                                      self._offset + pos)
+            end = colon + 1 + int(size)
+            if end >= len(buf):
+                break
+            if buf[end] != 0x2c:  # ','
+                raise JsonStreamError("Expecting ',' after netstring",
+                                      self._offset + end)
+            payload = bytes(buf[colon + 1:end])
+            try:
+                if skip is None:
+                    values.append(loads(payload))
+                else:
+                    text = payload.decode('utf-8')
+                    if not skip(text):
+                        values.append(loads(text))
+            except ValueError as e:
+                raise JsonStreamError(getattr(e, 'msg', str(e)),
+                                      self._offset + colon + 1)
+            pos = end + 1
+
+        del buf[:pos]
+        self._offset += pos
+        if self._filter is None:
+            return values
+        return self._filter.apply(values)
+
+    def _feed_text(self, text):
+        values = []
+        while text:
+            if self._tracker is None:
+                found, pos = _scan(text, self._skip)
+                values.extend(found)
+                pos = _WS_MATCH(text, pos).end()
+                self._consume(text, pos)
+                text = text[pos:]
+                if not text:
+                    break
+                if text[0] not in _VALUE_START:
+                    raise JsonStreamError(
+                        "Expecting value, got {!r}".format(text[0]),
+                        self._offset)
+                self._tracker = _ValueTracker(text[0])
+
+            end = self._tracker.advance(text)
+            if end < 0:
+                self._parts.append(text)
+                break
+            self._parts.append(text[:end])
+            text = text[end:]
+            values.append(self._decode_parts())
+        return values
+
+    def _decode_parts(self):
+        record = ''.join(self._parts)
+        self._parts = []
+        self._tracker = None
+        try:
+            value = _CODEC.loads(record)
+        except ValueError:
+            # the same fallback as _scan_lines, i.e. for NaN or big ints
+            try:
+                value = json.loads(record)
+            except ValueError as e:
+                pos = getattr(e, 'pos', None) or 0
+                self._consume(record, pos)
+                raise JsonStreamError(getattr(e, 'msg', str(e)),
+                                      self._offset)
+        self._consume(record, len(record))
+        return value
+
+    def _consume(self, text, pos):
+        """Advance the stream offset by the first ``pos`` chars of text."""
+        if self._binary:
+            pos = len(text[:pos].encode('utf-8'))
+        self._offset += pos
+
+
+class _RecordFilter(object):
+    """Project and filter decoded records, see `load_json_iter`."""
+    def __init__(self, fields=None, where=None):
+        self.fields = None if fields is None else tuple(fields)
+        self.match = None
+        self._needles = None
+
+        if isinstance(where, dict):
+            spec = []
+            for key, value in where.items():
+                if isinstance(value, (set, frozenset)):
+                    spec.append((key, tuple(value)))
+                else:
+                    spec.append((key, (value, )))
+            self.match = functools.partial(_match_spec, spec)
+
+            needles = [[json.dumps(v, ensure_ascii=False) for v in allowed]
+                       for _, allowed in spec
+                       if all(isinstance(v, str) for v in allowed)]
+            self._needles = [n for n in needles if n] or None
+        elif where is not None:
+            self.match = where
+
+    def apply(self, values):
+        """Return the matching ``values``, projected to ``fields``."""
+        if self.match is not None:
+            values = [v for v in values if self.match(v)]
+        if self.fields is not None:
+            fields = self.fields
+            values = [{k: v[k]
+                       for k in fields if k in v} if isinstance(v, dict) else v
+                      for v in values]
+        return values
+
+    def skip_line(self, line):
+        """Whether a line of json values can be skipped without decoding it.
+
+        A line without escapes must contain a string value exactly as it is
+        encoded. The line must also be whole values (it starts at a value
+        boundary and json strings can't contain a newline), otherwise
+        skipping it would change the value it is a part of.
+        """
+        if self._needles is None or '\\' in line:
+            return False
+        for needles in self._needles:
+            if not any(n in line for n in needles):
+                break
+        else:
+            return False
+
+        bare = _STRING_SUB('', line)
+        return ('"' not in bare and bare.count('{') == bare.count('}')
+                and bare.count('[') == bare.count(']'))
+
+
+def _match_spec(spec, value):
+    """Whether ``value`` is an object with an allowed value for each key."""
+    if not isinstance(value, dict):
+        return False
+    for key, allowed in spec:
+        if key not in value or value[key] not in allowed:
+            return False
+    return True
+
+
+class _ValueTracker(object):
+    """Find the end of a partial json value, looking at each character of the
+    stream only once.
+
+    Containers and strings are tracked by their nesting and quoting, scalars
+    (numbers, ``true``, etc) end at the first character which cannot be part
+    of them. The value itself is validated when it is decoded.
+    """
+    def __init__(self, first):
+        self.scalar = first not in '{["'
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def advance(self, text):
+        """Return the index in ``text`` after the end of the value, or -1."""
+        if self.scalar:
+            m = _SCALAR_END_SEARCH(text)
+            return -1 if m is None else m.start()
+
+        pos = 0
+        end = len(text)
+        while pos < end:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    pos += 1
+                    continue
+                pos = _STRING_BODY_MATCH(text, pos).end()
+                if pos == end:
+                    return -1
+                if text[pos] == '\\':
+                    # the escaped character is in the next chunk
+                    self.escape = True
+                    return -1
+                self.in_string = False
+                pos += 1
+                if self.depth == 0:
+                    return pos
+                continue
+
+            m = _STRUCTURE_SEARCH(text, pos)
+            if m is None:
+                return -1
+            c = m.group()
+            pos = m.end()
+            if c == '"':
+                self.in_string = True
+            elif c in '{[':
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth <= 0:
+                    return pos
+        return -1
+
+
+def _scan(buf, skip=None):
+    """Scan ``buf`` for json values with the fastest method available.
+
+    ``skip(line)`` can return True for complete lines which should be
+    skipped without decoding them.
+
+    See _scan_values for the return value.
+    """
+    if skip is not None:
+        return _scan_lines(buf, _CODEC.loads, skip)
+    if _CODEC.name == 'json':
+        return _scan_values(buf, 0)
+    return _scan_lines(buf, _CODEC.loads)
+
+
+def _scan_lines(buf, loads, skip=None):
+    """Decode each complete line of ``buf`` as a json value with ``loads``.
+
+    A line which ``loads`` decodes is exactly one json value, so this is
+    only a fast path: from the first line which is not (i.e. pretty printed
+    or space separated values) the rest of the buffer is scanned with
+    _scan_values.
+    """
+    end = buf.rfind('\n') + 1
+    if not end:
+        return _scan_values(buf, 0)
+
+    lines = buf[:end].split('\n')
+    lines.pop()
+    if skip is None:
+        try:
+            return list(map(loads, lines)), end
+        except ValueError:
+            pass
+
+    values = []
+    pos = 0
+    for line in lines:
+        if line and not (skip is not None and skip(line)):
+            try:
+                values.append(loads(line))
+            except ValueError:
+                more, pos = _scan_values(buf, pos)
+                return values + more, pos
+        pos += len(line) + 1
+    return values, end
+
+
+def _scan_values(buf, pos):
+    """Scan all complete json values in ``buf`` starting at ``pos``.
+
+    returns: (values, pos) where ``pos`` is the start of the remaining
+      partial (or invalid) value.
+    """
+    values = []
+    append = values.append
+    end = len(buf)
+    while True:
+        pos = _WS_MATCH(buf, pos).end()
+        if pos == end:
+            return values, pos
+
+        try:
+            value, nxt = _SCAN_ONCE(buf, pos)
+        except (StopIteration, ValueError):
+            return values, pos
+
+        if buf[pos] in _NUMBER_START and _SCALAR_END_SEARCH(buf, nxt) is None:
+            # A Number at the end of the buffer (i.e. "1." or "1e") may
+            # continue in the next chunk
+            return values, pos
+
+        append(value)
+        pos = nxt
+
+
+def __getattr__(name):
+    """Import `PopenJsh` (and with it subprocess) when it is first used."""
+    if name == 'PopenJsh':
+        from jshlib_process import PopenJsh
+        return PopenJsh
+    raise AttributeError("module {!r} has no attribute {!r}".format(
+        __name__, name))
 
-            elif c in _CURLY and not (open_string or open_bracket):
-                if c == '{':
-                    open_curly = True
-                    brackets += 1
-                elif c == '}':
-                    brackets -= 1
-                    if brackets == 0:
-                        # We found an Object
-                        text, i = consolodate_result(alltext, text, i)
-                        yield alltext
-                        alltext = []
-                        open_curly = False
-                        continue
 
-            i += 1
+if sys.version_info < (3, 7):
+    # a module __getattr__ is python3.7+
 
-        if text.strip():
-            alltext.append(text)
+    class _Module(type(sys)):
+        def __getattr__(self, name):
+            return __getattr__(name)
 
-    if alltext:
-        yield alltext
+    sys.modules[__name__].__class__ = _Module
@@ -0,0 +1,276 @@
+# jsh: JSON-RPC standards for the shell
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""
+jsh: asyncio API for running jsh processes.
+"""
+
+import asyncio
+from asyncio.subprocess import PIPE
+
+import jshlib
+
+
+async def run_jsh_async(cmd, method, params=None, inputs=None, timeout=None):
+    """Run a Jsh process without blocking the event loop.
+
+    `inputs` can be an iterable or async iterable of serializable values to
+    dump into the stream.
+
+    Returns (returncode, outputs, logs) the same as ``jshlib.run_jsh``.
+
+    raise: asyncio.TimeoutError if ``timeout`` seconds elapse, after killing
+      the process.
+    """
+    p = await AsyncPopenJsh.run_jsh(cmd=cmd, method=method, params=params)
+    outputs, logs = await p.communicate(inputs=inputs, timeout=timeout)
+    return p.returncode, outputs, logs
+
+
+class AsyncPopenJsh(object):
+    """Run a Jsh process in the background using asyncio.
+
+    Use the `run_jsh` classmethod to start it, or wrap your own
+    ``asyncio.subprocess.Process``.
+
+    If the task using `communicate` or `iter_records` is cancelled the process
+    is killed.
+    """
+    def __init__(self, process):
+        self.process = process
+        self._transport = None
+        self._framing = jshlib.FRAMING_LINES
+
+    @classmethod
+    async def run_jsh(cls,
+                      cmd,
+                      method,
+                      params=None,
+                      stdin=PIPE,
+                      stdout=PIPE,
+                      stderr=PIPE,
+                      transport=None,
+                      framing=None,
+                      **kwargs):
+        t = jshlib.RequestTransport(cmd,
+                                    method,
+                                    params,
+                                    transport=transport,
+                                    framing=framing)
+        try:
+            kwargs.update(t.popen_kwargs)
+            process = await asyncio.create_subprocess_exec(*t.args,
+                                                           stdin=stdin,
+                                                           stdout=stdout,
+                                                           stderr=stderr,
+                                                           **kwargs)
+        except BaseException:
+            t.close()
+            raise
+        t.started()
+        p = cls(process)
+        # pylint: disable=protected-access
+        p._transport = t
+        p._framing = framing or jshlib.FRAMING_LINES
+        return p
+
+    @property
+    def returncode(self):
+        """The return code of the process, None if it is still running."""
+        return self.process.returncode
+
+    async def communicate(self,
+                          inputs=None,
+                          timeout=None,
+                          fields=None,
+                          where=None,
+                          log_where=None):
+        """Communicate with the jsh process, returning the deserialized
+        stdout, stderr.
+
+        `fields`, `where` and `log_where` filter the records the same as
+        ``jshlib.PopenJsh.communicate``.
+
+        raise: asyncio.TimeoutError if ``timeout`` seconds elapse, after
+          killing the process.
+        """
+        try:
+            return await asyncio.wait_for(
+                self._communicate(inputs, fields, where, log_where), timeout)
+        except asyncio.TimeoutError:
+            # before python3.7 wait_for doesn't wait for the cancelled
+            # _communicate to kill the process
+            if self.returncode is None:
+                await self.kill()
+            raise
+
+    async def _communicate(self, inputs, fields, where, log_where):
+        # not with iter_records: an async generator can't be closed while
+        # this is suspended in it, i.e. when this coroutine is closed
+        outputs, logs = [], []
+        queue, writer, readers = self._start(inputs, fields, where, log_where)
+        closed = False
+        try:
+            done = 0
+            while done < len(readers):
+                record = await queue.get()
+                if record is None:
+                    done += 1
+                elif record[0] == jshlib.OUT:
+                    outputs.append(record[1])
+                else:
+                    logs.append(record[1])
+            await self._finish(writer, readers)
+        except GeneratorExit:
+            closed = True
+            raise
+        finally:
+            # a closed coroutine can't wait for the killed process
+            if self._stop([writer] + readers) and not closed:
+                await self.process.wait()
+        return outputs, logs
+
+    async def iter_records(self,
+                           inputs=None,
+                           fields=None,
+                           where=None,
+                           log_where=None):
+        """Yield ``(OUT, obj)`` and ``(LOG, obj)`` records as the jsh process
+        writes them to stdout and stderr.
+
+        `inputs` are written to stdin concurrently, waiting on the pipe's
+        backpressure. Once stdout and stderr are closed the rest of the
+        inputs are dropped. If the generator is closed before the process is
+        done the process is killed.
+
+        `fields`, `where` and `log_where` filter the records the same as
+        ``jshlib.PopenJsh.iter_records``.
+        """
+        queue, writer, readers = self._start(inputs, fields, where, log_where)
+        try:
+            done = 0
+            while done < len(readers):
+                record = await queue.get()
+                if record is None:
+                    done += 1
+                else:
+                    yield record
+            await self._finish(writer, readers)
+        finally:
+            if self._stop([writer] + readers):
+                await self.process.wait()
+
+    def _start(self, inputs, fields, where, log_where):
+        """Start writing the inputs and reading the records onto a queue,
+        which gets a None as each reader finishes.
+
+        returns: (queue, writer task, reader tasks)
+        """
+        queue = asyncio.Queue()
+        writer = asyncio.ensure_future(self._write_inputs(inputs))
+        readers = []
+        for stream, kind, parser in (
+            (self.process.stdout, jshlib.OUT,
+             jshlib.JsonStreamParser(fields, where, framing=self._framing)),
+            (self.process.stderr, jshlib.LOG,
+             jshlib.JsonStreamParser(where=log_where)),
+        ):
+            if stream is not None:
+                readers.append(
+                    asyncio.ensure_future(
+                        _read_records(stream, kind, parser, queue)))
+        return queue, writer, readers
+
+    async def _finish(self, writer, readers):
+        """Wait for the process once the readers are done.
+
+        The writer is cancelled: a slow input generator must not hold up a
+        process which closed its output.
+        """
+        if writer.done():
+            writer.result()
+        else:
+            writer.cancel()
+        await asyncio.gather(*readers)
+        await self.process.wait()
+
+    def _stop(self, tasks):
+        """Cancel the tasks, kill the process if it is still running and
+        close the request transport.
+
+        returns: whether the process was killed, which must be waited for.
+        """
+        for task in tasks:
+            task.cancel()
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        if self.process.returncode is not None:
+            return False
+        try:
+            self.process.kill()
+        except ProcessLookupError:
+            pass
+        return True
+
+    async def kill(self):
+        """Kill the process and wait for it to exit."""
+        try:
+            self.process.kill()
+        except ProcessLookupError:
+            pass
+        await self.process.wait()
+
+    async def _write_inputs(self, inputs):
+        stdin = self.process.stdin
+        if stdin is None:
+            return
+
+        try:
+            if inputs is None:
+                return
+            if hasattr(inputs, '__aiter__'):
+                async for value in inputs:
+                    await _write_value(stdin, value)
+            else:
+                for value in inputs:
+                    await _write_value(stdin, value)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            stdin.close()
+
+
+async def _write_value(stdin, value):
+    stdin.write(jshlib.get_codec().dumps(value).encode('utf-8'))
+    stdin.write(b'\n')
+    await stdin.drain()
+
+
+async def _read_records(stream, kind, scanner, queue):
+    """Put ``(kind, value)`` records on the queue, then None when done."""
+    try:
+        while True:
+            data = await stream.read(jshlib.CHUNK_SIZE)
+            if not data:
+                break
+            for value in scanner.feed(data):
+                queue.put_nowait((kind, value))
+
+        for value in scanner.close():
+            queue.put_nowait((kind, value))
+    finally:
+        queue.put_nowait(None)
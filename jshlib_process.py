@@ -0,0 +1,428 @@
+# jsh: JSON-RPC standards for the shell
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""
+jsh: run jsh commands as subprocesses with `PopenJsh`.
+
+It is kept out of jshlib so that importing jshlib doesn't import subprocess:
+``jshlib.PopenJsh`` imports this module when it is first used.
+"""
+# pylint: disable=protected-access,import-outside-toplevel,cyclic-import
+
+import os
+import time
+import functools
+import subprocess
+
+import jshlib
+
+
+class PopenJsh(subprocess.Popen):
+    """Run a Jsh process in the background using Popen.
+
+    Use the `run_jsh` classmethod to start it, or construct your own Popen.
+
+    This is similar to Popen but provides a generator for reading the logs and
+    data: use `communicate` to get everything once the process exits or
+    `iter_records` to stream records as they are written.
+    """
+    _transport = None
+    _framing = jshlib.FRAMING_LINES
+    _group = False
+    _limits = None
+    stats = None
+    # the Error of the limit which killed the process, see iter_records
+    limit_error = None
+
+    @classmethod
+    def run_jsh(cls,
+                cmd,
+                method,
+                params=None,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                transport=None,
+                stats=None,
+                framing=None,
+                timeout=None,
+                max_output_bytes=None,
+                max_records=None,
+                rlimit=None,
+                **kwargs):
+        """Start ``cmd`` with the request for ``method(params)``.
+
+        `transport` is how the request is sent and `framing` how its records
+        are requested to be framed, see RequestTransport. The records are
+        read the same either way.
+
+        `stats` can be a CallStats to fill in, available as ``p.stats``. If
+        the ``JSH_STATS`` environment variable is set every call records
+        them and writes them to stderr as a log record when it exits.
+
+        Limits (posix only):
+
+        - `timeout`: seconds from now until the process is killed.
+        - `max_output_bytes`: bytes the process may write to stdout.
+        - `max_records`: records the process may write to stdout.
+        - `rlimit`: a dict of ``resource`` limits set in the process, keyed by
+          their name without ``RLIMIT_`` (i.e. ``{"cpu": 10, "as": 2**30}``).
+          A value is the soft and hard limit, or a ``(soft, hard)`` tuple.
+          The hard ``cpu`` limit of a value is a second later, so that the
+          process gets SIGXCPU (see `iter_records`) rather than SIGKILL.
+
+        The first three are enforced by `iter_records` and `communicate`,
+        which can also be given them. With any limit the process is started
+        in its own process group, so the whole group can be killed.
+        """
+        # pylint: disable=too-many-locals
+        if stats is None and os.environ.get(jshlib.STATS_ENV):
+            stats = jshlib.CallStats(log=True)
+        limited = (timeout, max_output_bytes, max_records, rlimit) != (None, ) * 4
+        if limited and os.name == 'posix':
+            kwargs.setdefault('start_new_session', True)
+        if rlimit:
+            kwargs['preexec_fn'] = functools.partial(_set_rlimits,
+                                                     _rlimits(rlimit))
+        t = jshlib.RequestTransport(cmd,
+                                    method,
+                                    params,
+                                    transport=transport,
+                                    framing=framing)
+        start = None
+        if stats is not None or timeout is not None:
+            start = time.monotonic()
+        try:
+            kwargs.update(t.popen_kwargs)
+            p = cls(args=t.args,
+                    stdin=stdin,
+                    stderr=stderr,
+                    stdout=stdout,
+                    **kwargs)
+        except Exception:
+            t.close()
+            raise
+        t.started()
+        # pylint: disable=protected-access
+        p._transport = t
+        p._framing = framing or jshlib.FRAMING_LINES
+        p._group = bool(kwargs.get('start_new_session'))
+        p._limits = _Limits(timeout, max_output_bytes, max_records, rlimit,
+                            start)
+        if stats is not None:
+            stats.started(cmd, method, start)
+            p.stats = stats
+        return p
+
+    def __exit__(self, *exc):
+        try:
+            super(PopenJsh, self).__exit__(*exc)
+        finally:
+            self._close_transport()
+
+    def __del__(self, *args, **kwargs):
+        self._close_transport()
+        super(PopenJsh, self).__del__(*args, **kwargs)
+
+    def poll(self):
+        """Check if the process has exited, then clean up like `wait`."""
+        if self.stats is None or not self._wait4(0):
+            super(PopenJsh, self).poll()
+        if self.returncode is not None:
+            self._exited()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Wait for the process to exit, then clean up the request
+        transport and finish the stats."""
+        if self.stats is None or not self._wait4(timeout):
+            super(PopenJsh, self).wait(timeout)
+        if self.returncode is None:
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        self._exited()
+        return self.returncode
+
+    def _wait4(self, timeout):
+        """Reap the process with ``os.wait4`` to record its rusage in the
+        stats, waiting at most ``timeout`` seconds (forever if None).
+
+        returns: False if Popen must wait for it instead, i.e. it was
+          already reaped.
+        """
+        if not hasattr(os, 'wait4'):
+            return False
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0005
+        while True:
+            # Popen reaps under the same lock: a process must only be reaped
+            # once, else the other waitpid fails and Popen assumes it exited
+            # with 0
+            if self._waitpid_lock.acquire(deadline is None):
+                try:
+                    if self.returncode is not None:
+                        return False
+                    flags = 0 if deadline is None else os.WNOHANG
+                    try:
+                        pid, status, rusage = os.wait4(self.pid, flags)
+                    except ChildProcessError:
+                        return False
+                    if pid == self.pid:
+                        self.stats.rusage(rusage)
+                        self.returncode = _exit_code(status)
+                        return True
+                finally:
+                    self._waitpid_lock.release()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            time.sleep(min(delay, remaining))
+            delay = min(2 * delay, 0.05)
+
+    def _exited(self):
+        self._close_transport()
+        if self.stats is not None and self.stats.wall_s is None:
+            self.stats.exited(self.returncode)
+
+    def _close_transport(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    def _stream_stats(self, kind):
+        """The StreamStats of stdout (OUT) or stderr (LOG), or None."""
+        if self.stats is None:
+            return None
+        return self.stats.streams[kind]
+
+    # pylint: disable=too-many-arguments
+    def communicate(self,
+                    inputs=None,
+                    fields=None,
+                    where=None,
+                    log_where=None,
+                    timeout=None,
+                    max_output_bytes=None,
+                    max_records=None):
+        """Communicate with the jsh process, returning the deserialized
+        stdout, stderr.
+
+        `inputs` can be any iterable (i.e. a generator) of serializable values
+        to dump into the stream. They are encoded and written as the process
+        reads them while stdout and stderr are drained, so they never have
+        to fit in memory.
+
+        `fields` and `where` filter the outputs and `log_where` the logs, see
+        `load_json_iter`.
+
+        `timeout` (from now), `max_output_bytes` and `max_records` limit the
+        process, see `iter_records`.
+        """
+        outputs, logs = [], []
+        records = self.iter_records(inputs=inputs,
+                                    fields=fields,
+                                    where=where,
+                                    log_where=log_where,
+                                    timeout=timeout,
+                                    max_output_bytes=max_output_bytes,
+                                    max_records=max_records)
+        for kind, value in records:
+            if kind == jshlib.OUT:
+                outputs.append(value)
+            else:
+                logs.append(value)
+        return outputs, logs
+
+    def iter_records(self,
+                     inputs=None,
+                     fields=None,
+                     where=None,
+                     log_where=None,
+                     timeout=None,
+                     max_output_bytes=None,
+                     max_records=None):
+        """Yield ``(OUT, obj)`` and ``(LOG, obj)`` records as the jsh process
+        writes them to stdout and stderr.
+
+        `fields` and `where` filter the outputs and `log_where` the logs (i.e.
+        ``log_where={'lvl': 'ERROR'}``), see `load_json_iter`.
+
+        `inputs` can be any iterable of serializable values to dump into the
+        stream. They are encoded about CHUNK_SIZE bytes at a time, only when
+        the process is ready to read more.
+
+        stdin, stdout and stderr are multiplexed with ``selectors`` so that no
+        pipe can deadlock. The process is waited on once stdout and stderr are
+        closed.
+
+        If the process exceeds `timeout` (seconds from now),
+        `max_output_bytes` or `max_records` (or the limits given to
+        `run_jsh`) its process group is killed, also if it is still
+        running at the deadline after closing its pipes. The last record is
+        then ``(LOG, Error)`` with code ``Error.LIMIT_EXCEEDED`` and the name
+        of the limit in its data, which is also stored as ``limit_error``. The
+        error is also given if the process is killed by SIGXCPU with a
+        ``cpu`` rlimit.
+        """
+        # pylint: disable=too-many-locals
+        limits = _Limits(timeout, max_output_bytes, max_records)
+        if self._limits is not None:
+            limits = limits.merge(self._limits)
+        readers = [
+            (self.stdout, jshlib.OUT,
+             jshlib.JsonStreamParser(fields,
+                                     where,
+                                     stats=self._stream_stats(jshlib.OUT),
+                                     framing=self._framing)),
+            (self.stderr, jshlib.LOG,
+             jshlib.JsonStreamParser(where=log_where,
+                                     stats=self._stream_stats(jshlib.LOG))),
+        ]
+        max_bytes = None
+        if limits.max_output_bytes is not None:
+            max_bytes = {jshlib.OUT: limits.max_output_bytes}
+
+        records = 0
+        try:
+            for kind, value in jshlib._iter_pipes(self.stdin,
+                                                  inputs,
+                                                  readers,
+                                                  deadline=limits.deadline,
+                                                  max_bytes=max_bytes):
+                if kind == jshlib.OUT:
+                    records += 1
+                    if records > limits.max_records:
+                        raise jshlib._LimitExceeded('max_records', None)
+                yield kind, value
+            self._wait_deadline(limits.deadline)
+        except jshlib._LimitExceeded as e:
+            e.value = getattr(limits, e.limit)
+            self.kill_group()
+            self.limit_error = e.error(self.returncode)
+            yield jshlib.LOG, self.limit_error
+            return
+
+        if limits.killed_by_cpu(self.returncode):
+            self.limit_error = jshlib._LimitExceeded(
+                'cpu', limits.rlimit['cpu']).error(self.returncode)
+            yield jshlib.LOG, self.limit_error
+
+    def _wait_deadline(self, deadline):
+        """Wait for the process, until the (monotonic) deadline if given.
+
+        raise: _LimitExceeded if the deadline passes.
+        """
+        if deadline is None:
+            self.wait()
+            return
+        try:
+            self.wait(timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            raise jshlib._LimitExceeded('timeout', None)
+
+    def kill_group(self):
+        """Kill the process (and its process group if it was started in one)
+        and wait for it."""
+        import signal
+        try:
+            if self._group:
+                os.killpg(self.pid, signal.SIGKILL)
+            else:
+                self.kill()
+        except OSError:
+            pass  # already gone
+        for pipe in (self.stdin, self.stdout, self.stderr):
+            if pipe:
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+        self.wait()
+
+
+class _Limits(object):
+    """The limits of a PopenJsh, see `PopenJsh.run_jsh`."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 timeout=None,
+                 max_output_bytes=None,
+                 max_records=None,
+                 rlimit=None,
+                 start=None):
+        self.timeout = timeout
+        self.deadline = None
+        if timeout is not None:
+            start = time.monotonic() if start is None else start
+            self.deadline = start + timeout
+        self.max_output_bytes = max_output_bytes
+        self.max_records = jshlib._INF if max_records is None else max_records
+        self.rlimit = rlimit or {}
+
+    def merge(self, other):
+        """These limits, with the ones which aren't set taken from
+        ``other``."""
+        merged = _Limits(max_output_bytes=self.max_output_bytes,
+                         rlimit=self.rlimit or other.rlimit)
+        if self.deadline is not None:
+            merged.timeout, merged.deadline = self.timeout, self.deadline
+        else:
+            merged.timeout, merged.deadline = other.timeout, other.deadline
+        if merged.max_output_bytes is None:
+            merged.max_output_bytes = other.max_output_bytes
+        merged.max_records = min(self.max_records, other.max_records)
+        return merged
+
+    def killed_by_cpu(self, returncode):
+        """Whether the process was killed by its cpu rlimit.
+
+        Only SIGXCPU is counted: SIGKILL may just as well be from anything
+        else, i.e. the OOM killer.
+        """
+        if 'cpu' not in self.rlimit or not returncode or returncode > 0:
+            return False
+        import signal
+        return -returncode == signal.SIGXCPU
+
+
+def _exit_code(status):
+    """The Popen returncode of an ``os.wait`` status."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _rlimits(rlimit):
+    """Resolve a `PopenJsh.run_jsh` rlimit dict to ``resource`` limits."""
+    import resource
+    limits = []
+    for name, value in rlimit.items():
+        key = getattr(resource, 'RLIMIT_' + name.upper(), None)
+        if key is None:
+            raise ValueError("Unknown rlimit: {}".format(name))
+        if not isinstance(value, tuple):
+            hard = value
+            if key == resource.RLIMIT_CPU and value != resource.RLIM_INFINITY:
+                hard = value + 1
+            value = (value, hard)
+        limits.append((key, value))
+    return limits
+
+
+def _set_rlimits(limits):
+    """Set the resolved rlimits, in the child process before exec."""
+    import resource
+    for key, value in limits:
+        resource.setrlimit(key, value)
@@ -0,0 +1,562 @@
+# jsh: JSON-RPC standards for the shell
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""
+jsh: query json records with a subset of the ``jq`` language.
+
+This is used by ``jsh q=<query>``:
+
+    for value in query_iter('select(.lvl == "ERROR") | .msg',
+                            jshlib.load_json_iter(sys.stdin.buffer)):
+        jshlib.dump_stdout(value)
+"""
+
+import re
+import json
+import itertools
+
+_WS_MATCH = re.compile(r'[ \t\n\r]*').match
+
+
+def compile_query(text):
+    """Compile a query, a subset of the ``jq`` language, into a function of
+    one json value which returns the list of its results.
+
+    The supported subset is:
+
+    - paths: ``.``, ``.foo``, ``."foo"``, ``.[0]``, ``.[-1]``, ``.["foo"]``,
+      ``.[1:3]`` and ``.[]`` (iterate), each followed by ``?`` to ignore
+      errors.
+    - ``f | g`` (pipe) and ``f, g`` (both).
+    - literals (json strings and numbers, ``true``, ``false``, ``null``),
+      ``[f]`` (collect) and ``{key: f, "key": f, (f): g, key}`` (construct).
+    - ``==``, ``!=``, ``<``, ``<=``, ``>``, ``>=``, ``and`` and ``or``.
+    - ``select(f)``, ``map(f)``, ``has(f)``, ``length``, ``keys``, ``not``
+      and ``empty``.
+
+    The query is parsed once into nested closures which are called for each
+    value.
+
+    raise: ValueError if the query is invalid. The returned function raises
+      ValueError if a value can't be queried (i.e. ``.foo`` of a list).
+    """
+    return _QueryParser(text).parse()
+
+
+def query_iter(query, values):
+    """Apply a query (text or from `compile_query`) to each value, yielding
+    the results.
+
+    i.e. ``query_iter('.msg', jshlib.load_json_iter(f))``
+    """
+    if isinstance(query, str):
+        query = compile_query(query)
+    return itertools.chain.from_iterable(map(query, values))
+
+
+class _QueryParser(object):
+    """Recursive descent parser which compiles a query into closures.
+
+    From lowest to highest precedence: ``|``, ``,``, ``or``, ``and``,
+    comparisons then terms with their suffixes.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize_query(text)
+        self.pos = 0
+
+    def parse(self):
+        fn = self.pipe()
+        if self.peek()[0] != 'end':
+            raise self.unexpected()
+        return fn
+
+    def peek(self, ahead=0):
+        return self.tokens[min(self.pos + ahead, len(self.tokens) - 1)]
+
+    def accept(self, text):
+        kind, tok, _ = self.peek()
+        if kind in ('op', 'ident') and tok == text:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, text):
+        if not self.accept(text):
+            raise self.error("Expected {!r}".format(text))
+
+    def error(self, msg):
+        pos = self.peek()[2]
+        return ValueError("{} at position {} of query {!r}".format(
+            msg, pos, self.text))
+
+    def unexpected(self):
+        tok = self.peek()[1]
+        return self.error(
+            "Unexpected {!r}".format(tok) if tok else "Unexpected end")
+
+    def pipe(self):
+        fn = self.comma()
+        while self.accept('|'):
+            fn = _query_pipe(fn, self.comma())
+        return fn
+
+    def comma(self):
+        fn = self.or_()
+        while self.accept(','):
+            fn = _query_comma(fn, self.or_())
+        return fn
+
+    def or_(self):
+        fn = self.and_()
+        while self.accept('or'):
+            fn = _query_or(fn, self.and_())
+        return fn
+
+    def and_(self):
+        fn = self.compare()
+        while self.accept('and'):
+            fn = _query_and(fn, self.compare())
+        return fn
+
+    def compare(self):
+        fn = self.postfix()
+        kind, tok, _ = self.peek()
+        if kind == 'op' and tok in _QUERY_COMPARE:
+            self.pos += 1
+            fn = _query_binary(_QUERY_COMPARE[tok], fn, self.postfix())
+        return fn
+
+    def postfix(self):
+        fn = self.term()
+        while True:
+            kind, tok, _ = self.peek()
+            if kind == 'field':
+                self.pos += 1
+                fn = _query_pipe(fn, _query_field(tok[1:]))
+            elif kind == 'op' and tok == '.' and self.peek(1)[0] == 'string':
+                self.pos += 1
+                fn = _query_pipe(fn, _query_field(self.string()))
+            elif kind == 'op' and tok == '.' and self.peek(1)[1] == '[':
+                self.pos += 1
+            elif self.accept('['):
+                fn = self.brackets(fn)
+            elif self.accept('?'):
+                fn = _query_try(fn)
+            else:
+                return fn
+
+    def brackets(self, base):
+        """Parse the rest of ``base[...]``."""
+        if self.accept(']'):
+            return _query_pipe(base, _query_iterate)
+        start = None if self.peek()[1] == ':' else self.pipe()
+        if self.accept(':'):
+            end = None if self.peek()[1] == ']' else self.pipe()
+            self.expect(']')
+            return _query_slice(base, start, end)
+        self.expect(']')
+        return _query_index(base, start)
+
+    def term(self):
+        kind, tok, _ = self.peek()
+        self.pos += 1
+        if kind == 'field':
+            return _query_field(tok[1:])
+        if kind == 'number':
+            return _query_const(json.loads(tok))
+        if kind == 'string':
+            self.pos -= 1
+            return _query_const(self.string())
+        if kind == 'ident':
+            return self.builtin(tok)
+        if tok == '.':
+            if self.peek()[0] == 'string':
+                return _query_field(self.string())
+            return _query_identity
+        if tok == '(':
+            fn = self.pipe()
+            self.expect(')')
+            return fn
+        if tok == '[':
+            if self.accept(']'):
+                return _query_collect(_query_empty)
+            fn = self.pipe()
+            self.expect(']')
+            return _query_collect(fn)
+        if tok == '{':
+            return self.construct()
+
+        self.pos -= 1
+        raise self.unexpected()
+
+    def string(self):
+        kind, tok, _ = self.peek()
+        if kind != 'string':
+            raise self.error("Expected a string")
+        try:
+            value = json.loads(tok)
+        except ValueError as e:
+            raise self.error("Invalid string ({})".format(e))
+        self.pos += 1
+        return value
+
+    def builtin(self, name):
+        if name in _QUERY_CONSTS:
+            return _query_const(_QUERY_CONSTS[name])
+        if name in _QUERY_FILTERS:
+            return _QUERY_FILTERS[name]
+        if name in _QUERY_FUNCTIONS:
+            self.expect('(')
+            arg = self.pipe()
+            self.expect(')')
+            return _QUERY_FUNCTIONS[name](arg)
+
+        self.pos -= 1
+        raise self.error("Unknown function {!r}".format(name))
+
+    def construct(self):
+        """Parse the rest of ``{key: value, ...}``."""
+        entries = []
+        if self.accept('}'):
+            return _query_construct(entries)
+        while True:
+            entries.append(self.entry())
+            if self.accept('}'):
+                return _query_construct(entries)
+            self.expect(',')
+
+    def entry(self):
+        kind, tok, _ = self.peek()
+        if kind in ('ident', 'string'):
+            key = self.string() if kind == 'string' else tok
+            if kind == 'ident':
+                self.pos += 1
+            if not self.accept(':'):
+                # {key} is {key: .key}
+                return _query_const(key), _query_field(key)
+            keyf = _query_const(key)
+        elif self.accept('('):
+            keyf = self.pipe()
+            self.expect(')')
+            self.expect(':')
+        else:
+            raise self.error("Expected an object key")
+
+        # like jq, a value is only a term unless it is in parenthesis
+        valuef = self.postfix()
+        while self.accept('|'):
+            valuef = _query_pipe(valuef, self.postfix())
+        return keyf, valuef
+
+
+_QUERY_TOKEN_MATCH = re.compile(
+    r'''(?P<string>"(?:[^"\\]|\\.)*")
+      | (?P<number>-?[0-9]+(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?)
+      | (?P<field>\.[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<ident>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<op>==|!=|<=|>=|[.\[\](){}|,:?<>])
+    ''', re.VERBOSE).match
+
+
+def _tokenize_query(text):
+    """Split a query into ``(kind, text, position)`` tokens."""
+    tokens = []
+    end = len(text)
+    pos = _WS_MATCH(text, 0).end()
+    while pos < end:
+        m = _QUERY_TOKEN_MATCH(text, pos)
+        if m is None:
+            raise ValueError("Invalid character {!r} at position {} of "
+                             "query {!r}".format(text[pos], pos, text))
+        tokens.append((m.lastgroup, m.group(), pos))
+        pos = _WS_MATCH(text, m.end()).end()
+    tokens.append(('end', '', end))
+    return tokens
+
+
+# The compiled query functions take a json value and return a list of results
+
+
+def _query_identity(value):
+    return [value]
+
+
+def _query_empty(_value):
+    return []
+
+
+def _query_const(const):
+    return lambda _value: [const]
+
+
+def _query_pipe(f, g):
+    return lambda value: [r for v in f(value) for r in g(v)]
+
+
+def _query_comma(f, g):
+    return lambda value: f(value) + g(value)
+
+
+def _query_collect(f):
+    return lambda value: [list(f(value))]
+
+
+def _query_try(f):
+    def query(value):
+        try:
+            return f(value)
+        except ValueError:
+            return []
+
+    return query
+
+
+def _query_field(key):
+    def query(value):
+        if isinstance(value, dict):
+            return [value.get(key)]
+        return [_query_get(value, key)]
+
+    return query
+
+
+def _query_index(base, keyf):
+    # the key is evaluated on the input, not the output of base
+    return lambda value: [
+        _query_get(v, k) for k in keyf(value) for v in base(value)
+    ]
+
+
+def _query_slice(base, startf, endf):
+    def query(value):
+        starts = [None] if startf is None else startf(value)
+        ends = [None] if endf is None else endf(value)
+        return [
+            _query_get_slice(v, start, end) for end in ends
+            for start in starts for v in base(value)
+        ]
+
+    return query
+
+
+def _query_or(f, g):
+    def query(value):
+        out = []
+        for a in f(value):
+            if _query_truthy(a):
+                out.append(True)
+            else:
+                out.extend(_query_truthy(b) for b in g(value))
+        return out
+
+    return query
+
+
+def _query_and(f, g):
+    def query(value):
+        out = []
+        for a in f(value):
+            if _query_truthy(a):
+                out.extend(_query_truthy(b) for b in g(value))
+            else:
+                out.append(False)
+        return out
+
+    return query
+
+
+def _query_binary(op, f, g):
+    return lambda value: [op(a, b) for b in g(value) for a in f(value)]
+
+
+def _query_construct(entries):
+    def query(value):
+        objs = [{}]
+        for keyf, valuef in entries:
+            keys = keyf(value)
+            values = valuef(value)
+            objs = [
+                _query_with_item(obj, k, v) for obj in objs for k in keys
+                for v in values
+            ]
+        return objs
+
+    return query
+
+
+def _query_with_item(obj, key, value):
+    if not isinstance(key, str):
+        raise ValueError("Object keys must be strings, not {}".format(
+            _query_type(key)))
+    obj = dict(obj)
+    obj[key] = value
+    return obj
+
+
+def _query_select(f):
+    return lambda value: [
+        value for c in f(value) if c is not None and c is not False
+    ]
+
+
+def _query_map(f):
+    return lambda value: [[r for v in _query_iterate(value) for r in f(v)]]
+
+
+def _query_has(f):
+    def query(value):
+        out = []
+        for key in f(value):
+            if isinstance(value, dict) and isinstance(key, str):
+                out.append(key in value)
+            elif isinstance(value, list) and _query_is_number(key):
+                out.append(0 <= key < len(value))
+            else:
+                raise ValueError("Cannot check whether {} has a {} key".format(
+                    _query_type(value), _query_type(key)))
+        return out
+
+    return query
+
+
+def _query_iterate(value):
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, dict):
+        return list(value.values())
+    raise ValueError("Cannot iterate over {}".format(_query_type(value)))
+
+
+def _query_length(value):
+    if value is None:
+        return [0]
+    if isinstance(value, (str, list, dict)):
+        return [len(value)]
+    if _query_is_number(value):
+        return [abs(value)]
+    raise ValueError("{} has no length".format(_query_type(value)))
+
+
+def _query_keys(value):
+    if isinstance(value, dict):
+        return [sorted(value)]
+    if isinstance(value, list):
+        return [list(range(len(value)))]
+    raise ValueError("{} has no keys".format(_query_type(value)))
+
+
+def _query_not(value):
+    return [not _query_truthy(value)]
+
+
+def _query_get(value, key):
+    """``value[key]`` with jq's semantics."""
+    if isinstance(value, dict) and isinstance(key, str):
+        return value.get(key)
+    if isinstance(value, list) and _query_is_number(key):
+        index = int(key)
+        if index < 0:
+            index += len(value)
+        return value[index] if 0 <= index < len(value) else None
+    if value is None and (isinstance(key, str) or _query_is_number(key)):
+        return None
+    raise ValueError("Cannot index {} with {}".format(_query_type(value),
+                                                      _query_type(key)))
+
+
+def _query_get_slice(value, start, end):
+    """``value[start:end]`` with jq's semantics."""
+    for bound in (start, end):
+        if bound is not None and not _query_is_number(bound):
+            raise ValueError("Slice indices must be numbers, not {}".format(
+                _query_type(bound)))
+    if value is None:
+        return None
+    if isinstance(value, (list, str)):
+        return value[None if start is None else int(start):
+                     None if end is None else int(end)]
+    raise ValueError("Cannot slice {}".format(_query_type(value)))
+
+
+def _query_truthy(value):
+    return value is not None and value is not False
+
+
+def _query_is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _query_type(value):
+    """The jq name of the type of a json value."""
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, list):
+        return 'array'
+    return 'object'
+
+
+def _query_order(value):
+    """Sort key of a json value: jq orders null, false, true, numbers,
+    strings, arrays then objects."""
+    if value is None:
+        return (0, )
+    if value is False:
+        return (1, )
+    if value is True:
+        return (2, )
+    if isinstance(value, (int, float)):
+        return (3, value)
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, list):
+        return (5, [_query_order(v) for v in value])
+    keys = sorted(value)
+    return (6, keys, [_query_order(value[k]) for k in keys])
+
+
+def _query_equal(a, b):
+    if a.__class__ is b.__class__ and not isinstance(a, (list, dict)):
+        return a == b
+    return _query_order(a) == _query_order(b)
+
+
+_QUERY_COMPARE = {
+    '==': _query_equal,
+    '!=': lambda a, b: not _query_equal(a, b),
+    '<': lambda a, b: _query_order(a) < _query_order(b),
+    '<=': lambda a, b: _query_order(a) <= _query_order(b),
+    '>': lambda a, b: _query_order(a) > _query_order(b),
+    '>=': lambda a, b: _query_order(a) >= _query_order(b),
+}
+_QUERY_CONSTS = {'true': True, 'false': False, 'null': None}
+_QUERY_FILTERS = {
+    'empty': _query_empty,
+    'length': _query_length,
+    'keys': _query_keys,
+    'not': _query_not,
+}
+_QUERY_FUNCTIONS = {
+    'select': _query_select,
+    'map': _query_map,
+    'has': _query_has,
+}
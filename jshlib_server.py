@@ -0,0 +1,371 @@
+# jsh: JSON-RPC standards for the shell
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""
+jsh: host jsh commands on a unix socket or a localhost http port.
+
+Clients send JSON-RPC requests and get back newline separated json records:
+``{"out": value}`` and ``{"log": value}`` as the command writes them, then
+the JSON-RPC response, whose result is ``{"returncode": rc}``.
+
+    python jshlib_server.py --unix /tmp/jsh.sock echo=tests/echo
+    python jshlib_server.py --port 8080 --warm echo echo=tests/echo
+
+- unix socket: write a request per line, the records of each request are
+  written back in turn.
+- http: ``POST /`` a request, the records are the (streamed) body. ``GET
+  /stats`` returns the metrics.
+"""
+
+import os
+import sys
+import argparse
+import threading
+import socketserver
+from http import server as http_server
+
+import jshlib
+
+# JSON-RPC reserves -32000 to -32099 for server errors
+SERVER_BUSY = -32000
+STATS_METHOD = 'jsh.stats'
+NDJSON = 'application/x-ndjson'
+
+
+class JshServer(object):
+    """Run jsh commands for many clients with bounded concurrency.
+
+    ``commands`` is a dict of ``{method: cmd}``: a request for ``method`` runs
+    ``cmd`` with the same method and params. At most ``max_workers`` commands
+    run at a time and at most ``max_queue`` more requests wait for one to
+    finish. Requests beyond that are rejected immediately with a
+    ``SERVER_BUSY`` error (http 503) instead of piling up.
+
+    Commands which support ``--jsh-serve`` can be listed in ``warm``: they
+    are kept running in a jshlib.WorkerPool of ``warm_size`` processes (the
+    default is ``max_workers``) instead of being started for every request.
+    Their result is sent as a single ``out`` record.
+
+    Use `unix_server` or `http_server` to listen, `stats` (or the
+    ``jsh.stats`` method) for the queue depth and counters.
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self,
+                 commands,
+                 max_workers=None,
+                 max_queue=None,
+                 warm=(),
+                 warm_size=None):
+        self.commands = dict(commands)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queue = 4 * self.max_workers if max_queue is None else max_queue
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._lock = threading.Lock()
+        self._running = 0
+        self._queued = 0
+        self._counts = {
+            'accepted': 0,
+            'rejected': 0,
+            'completed': 0,
+            'failed': 0,
+            'max_queued': 0,
+        }
+        self._pools = {}
+        try:
+            for method in warm:
+                self._pools[method] = jshlib.WorkerPool(
+                    self.commands[method], size=warm_size or self.max_workers)
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop the warm workers."""
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            pool.close()
+
+    def stats(self):
+        """The current queue depth and the counters since the start."""
+        with self._lock:
+            stats = dict(self._counts)
+            stats.update(running=self._running,
+                         queued=self._queued,
+                         max_workers=self.max_workers,
+                         max_queue=self.max_queue)
+        return stats
+
+    def handle(self, req):
+        """Run a Request, yielding the records to send back.
+
+        The last record is always the JSON-RPC response (or error response).
+        Closing the generator early kills the command.
+        """
+        if req.method == STATS_METHOD:
+            yield jshlib.response(self.stats(), req.id)
+            return
+
+        cmd = self.commands.get(req.method)
+        if cmd is None:
+            err = jshlib.Error(code=jshlib.Error.METHOD_NOT_FOUND,
+                               message="Unknown method",
+                               data={'method': req.method})
+            yield jshlib.error_response(err, req.id)
+            return
+
+        if not self._admit():
+            err = jshlib.Error(code=SERVER_BUSY,
+                               message="Server busy",
+                               data=self.stats())
+            yield jshlib.error_response(err, req.id)
+            return
+
+        ok = False
+        try:
+            if req.method in self._pools:
+                records = self._call_warm(req)
+            else:
+                records = self._run(cmd, req)
+            for record in records:
+                ok = jshlib.RESULT in record
+                yield record
+        except Exception as exc:  # pylint: disable=broad-except
+            yield jshlib.error_response(
+                jshlib.Error.internal_exc(exc, tb=False), req.id)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._counts['completed' if ok else 'failed'] += 1
+            self._slots.release()
+
+    def _admit(self):
+        """Wait for a free worker, unless the queue is full."""
+        with self._lock:
+            if self._running + self._queued >= self.max_workers + self.max_queue:
+                self._counts['rejected'] += 1
+                return False
+            self._queued += 1
+            self._counts['accepted'] += 1
+            self._counts['max_queued'] = max(self._counts['max_queued'],
+                                             self._queued)
+        self._slots.acquire()
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        return True
+
+    def _call_warm(self, req):
+        try:
+            result = self._pools[req.method].call(req.method, req.params)
+        except jshlib.Error as err:
+            yield jshlib.error_response(err, req.id)
+            return
+        yield {jshlib.OUT: result}
+        yield jshlib.response({'returncode': 0}, req.id)
+
+    @staticmethod
+    def _run(cmd, req):
+        p = jshlib.PopenJsh.run_jsh(cmd, req.method, req.params)
+        try:
+            for kind, obj in p.iter_records():
+                yield {kind: obj}
+        finally:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+
+        if p.returncode:
+            err = jshlib.Error(code=jshlib.Error.INTERNAL_ERROR,
+                               message="Command failed",
+                               data={'returncode': p.returncode})
+            yield jshlib.error_response(err, req.id)
+        else:
+            yield jshlib.response({'returncode': 0}, req.id)
+
+    def unix_server(self, path):
+        """A socketserver listening on the unix socket ``path``.
+
+        Call ``serve_forever`` on it (i.e. in a thread) and ``shutdown``.
+        """
+        srv = _UnixServer(path, _StreamHandler)
+        srv.jsh = self
+        return srv
+
+    def http_server(self, port=0, host='127.0.0.1'):
+        """A http server on ``host:port`` (a free port if 0, see
+        ``server_address``)."""
+        srv = _HttpServer((host, port), _HttpHandler)
+        srv.jsh = self
+        return srv
+
+    def requests(self, line):
+        """Parse a line (or body) into Requests, or an error response."""
+        try:
+            reqs = jshlib.parse_jsh_request(line)
+        except ValueError as e:
+            err = jshlib.Error(code=jshlib.Error.PARSE_ERROR,
+                               message=str(e),
+                               data=None)
+            return None, jshlib.error_response(err, None)
+        reqs = reqs if isinstance(reqs, list) else [reqs]
+        for req in reqs:
+            if isinstance(req, jshlib.Error):
+                return None, jshlib.error_response(req, None)
+        return reqs, None
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    jsh = None
+
+    def server_close(self):
+        super(_UnixServer, self).server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+class _StreamHandler(socketserver.StreamRequestHandler):
+    """A request per line, records are written back as they arrive."""
+    def handle(self):
+        jsh = self.server.jsh
+        writer = jshlib.RecordWriter(self.wfile, always=True)
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            reqs, err = jsh.requests(line.decode('utf-8'))
+            if err is not None:
+                writer.write(err)
+                continue
+            for req in reqs:
+                if not _write_all(writer, jsh.handle(req)):
+                    return
+
+
+class _HttpServer(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    daemon_threads = True
+    jsh = None
+
+
+class _HttpHandler(http_server.BaseHTTPRequestHandler):
+    """``POST /`` a request, ``GET /stats``.
+
+    The body is streamed until the connection is closed (HTTP/1.0).
+    """
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path.rstrip('/') != '/stats':
+            self.send_error(404)
+            return
+        self._reply(200, 'application/json', [self.server.jsh.stats()])
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        jsh = self.server.jsh
+        size = int(self.headers.get('Content-Length') or 0)
+        reqs, err = jsh.requests(self.rfile.read(size).decode('utf-8'))
+        if err is not None:
+            self._reply(400, NDJSON, [err])
+            return
+        if len(reqs) != 1:
+            err = jshlib.Error(code=jshlib.Error.INVALID_REQUEST,
+                               message="Send a single request",
+                               data=None)
+            self._reply(400, NDJSON, [jshlib.error_response(err, None)])
+            return
+
+        records = jsh.handle(reqs[0])
+        first = next(records)
+        error = first.get(jshlib.RPC_ERROR) or {}
+        status = 503 if error.get(jshlib.CODE) == SERVER_BUSY else 200
+        self.send_response(status)
+        self.send_header('Content-Type', NDJSON)
+        self.end_headers()
+        writer = jshlib.RecordWriter(self.wfile, always=True)
+        writer.write(first)
+        _write_all(writer, records)
+
+    def _reply(self, status, content_type, records):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        _write_all(jshlib.RecordWriter(self.wfile, always=True), records)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        jshlib.dump_stderr(
+            jshlib.log_payload(format % args,
+                               lvl=jshlib.INFO,
+                               data={'client': self.address_string()}))
+
+
+def _write_all(writer, records):
+    """Write the records, closing them if the client went away.
+
+    returns: whether all records were written.
+    """
+    try:
+        for record in records:
+            writer.write(record)
+    except (BrokenPipeError, ConnectionResetError):
+        return False
+    finally:
+        if hasattr(records, 'close'):
+            records.close()
+    return True
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Host jsh commands")
+    listen = parser.add_mutually_exclusive_group(required=True)
+    listen.add_argument('--unix', help='path of the unix socket')
+    listen.add_argument('--port', type=int, help='localhost http port')
+    parser.add_argument('--workers', type=int, help='commands run at a time')
+    parser.add_argument('--max-queue', type=int, help='requests waiting')
+    parser.add_argument('--warm',
+                        action='append',
+                        default=[],
+                        help='a --jsh-serve method to keep running')
+    parser.add_argument('commands',
+                        nargs='+',
+                        metavar='method=cmd',
+                        help='the command which runs each method')
+    args = parser.parse_args(argv[1:])
+
+    commands = dict(c.partition('=')[::2] for c in args.commands)
+    with JshServer(commands,
+                   max_workers=args.workers,
+                   max_queue=args.max_queue,
+                   warm=args.warm) as jsh:
+        if args.unix:
+            srv = jsh.unix_server(args.unix)
+        else:
+            srv = jsh.http_server(args.port)
+        with srv:
+            try:
+                srv.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -25,7 +25,10 @@ def read(*names, **kwargs):
 
 setup(
   name = 'jshlib',
-  packages = ['jshlib.py'],
+  py_modules = [
+      'jshlib', 'jshlib_async', 'jshlib_process', 'jshlib_query',
+      'jshlib_server'
+  ],
   version = '0.1.0',
   license='MIT or APACHE-2.0',
   description = 'JSON-RPC standards for the shell',
@@ -44,10 +47,7 @@ setup(
       'Operating System :: POSIX',
       'Operating System :: Microsoft :: Windows',
       'Programming Language :: Python',
-      'Programming Language :: Python :: 2.7',
       'Programming Language :: Python :: 3',
-      'Programming Language :: Python :: 3.4',
-      'Programming Language :: Python :: 3.5',
       'Programming Language :: Python :: 3.6',
       'Programming Language :: Python :: 3.7',
       'Programming Language :: Python :: Implementation :: CPython',
@@ -62,7 +62,7 @@ setup(
   keywords=[
       # eg: 'keyword1', 'keyword2', 'keyword3',
   ],
-  python_requires='>=2.7',
+  python_requires='>=3.6',
   install_requires=[
   ],
   package_data={},
@@ -5,6 +5,10 @@ import subprocess
 import json
 import jshlib
 from pprint import pprint
+import threading
+import time
+import shutil
+import tempfile
 
 TESTS = os.path.dirname(os.path.abspath(__file__))
 ECHO = os.path.join(TESTS, 'echo')
@@ -178,6 +182,80 @@ class TestJsh(unittest.TestCase):
         assert rc == 1
 
 
+class TestJshQuery(unittest.TestCase):
+    def call(self, query, stdin):
+        env = {
+            "PYTHONPATH": "{}:{}".format(REPO, os.environ.get("PYTHONPATH",
+                                                              ""))
+        }
+        p = subprocess.Popen([JSH, "q=" + query],
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             env=env)
+        stdout, stderr = p.communicate(stdin)
+        return (p.returncode, list(jshlib.load_json_iter(stdout)),
+                convert_stderr(stderr))
+
+    def test_filter(self):
+        stdin = b'{"lvl": "INFO", "msg": "a"}\n{"lvl": "ERROR", "msg": "b"}\n'
+        rc, outputs, logs = self.call('select(.lvl == "ERROR") | {msg}',
+                                      stdin)
+        assert [{"msg": "b"}] == outputs
+        assert [] == logs
+        assert 0 == rc
+
+    def test_invalid_query(self):
+        rc, outputs, logs = self.call('.lvl |', b'{}')
+        assert [] == outputs
+        assert [jshlib.Error.INVALID_PARAMS] == [l["code"] for l in logs]
+        assert 1 == rc
+
+
+class TestJshBatch(unittest.TestCase):
+    STDIN = (b'm=foo --a=1\n'
+             b'\n'
+             b'["m=bar", "--b=\\"x y\\""]\n'
+             b'm=baz --c="unterminated\n'
+             b'--x=1\n')
+
+    def call(self, mode):
+        env = {
+            "PYTHONPATH": "{}:{}".format(REPO, os.environ.get("PYTHONPATH",
+                                                              ""))
+        }
+        p = subprocess.Popen([JSH, mode],
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             env=env)
+        stdout, stderr = p.communicate(self.STDIN)
+        return (p.returncode, list(jshlib.load_json_iter(stdout)),
+                convert_stderr(stderr))
+
+    def test_lines(self):
+        rc, outputs, _ = self.call("batch")
+
+        assert 4 == len(outputs)
+        assert jshlib.request("foo", {"a": 1}) == outputs[0]
+        assert jshlib.request("bar", {"b": "x y"}) == outputs[1]
+        assert [jshlib.Error.INVALID_PARAMS] * 2 == [
+            o["code"] for o in outputs[2:]
+        ]
+        assert [4, 5] == [o["data"]["line"] for o in outputs[2:]]
+        assert 1 == rc
+
+    def test_array(self):
+        rc, outputs, logs = self.call("batch=array")
+
+        assert [[
+            jshlib.request("foo", {"a": 1}, id=1),
+            jshlib.request("bar", {"b": "x y"}, id=3),
+        ]] == outputs
+        assert [4, 5] == [l["data"]["line"] for l in logs if "code" in l]
+        assert 1 == rc
+
+
 class TestRunJsh(unittest.TestCase):
     def test_echo_method_only(self):
         request = jshlib.Request("echo")
@@ -197,3 +275,461 @@ class TestRunJsh(unittest.TestCase):
         assert ["foo"] == outputs
         assert [request.serialize()] == logs
         assert 0 == returncode
+
+    def test_request_transports(self):
+        request = jshlib.Request("echo", {"files": ["f"] * 10})
+        for transport in (jshlib.TRANSPORT_ARGV, jshlib.TRANSPORT_FD,
+                          jshlib.TRANSPORT_FILE):
+            p = jshlib.PopenJsh.run_jsh(ECHO, request.method, request.params,
+                                        transport=transport)
+            path = p.args[1].partition('=')[2]
+            outputs, logs = p.communicate()
+
+            assert [request.serialize()] == logs, transport
+            assert 0 == p.returncode
+            if transport == jshlib.TRANSPORT_FILE:
+                assert not os.path.exists(path)
+
+    def test_request_file_removed(self):
+        def start():
+            p = jshlib.PopenJsh.run_jsh(ECHO, "echo",
+                                        transport=jshlib.TRANSPORT_FILE)
+            path = p.args[1].partition('=')[2]
+            assert os.path.exists(path)
+            return p, path
+
+        # reaped by poll
+        p, path = start()
+        p.stdin.close()
+        while p.poll() is None:
+            time.sleep(0.01)
+        assert not os.path.exists(path)
+        p.stdout.close()
+        p.stderr.close()
+
+        # used as a context manager, or never waited for
+        with start()[0] as p:
+            path = p.args[1].partition('=')[2]
+        assert not os.path.exists(path)
+
+        p, path = start()
+        p.kill()
+        del p
+        assert not os.path.exists(path)
+
+    def test_large_request(self):
+        # well over the per argument limit of linux (128KiB)
+        params = {"files": ["some/long/file/path.c"] * 20000}
+        p = jshlib.PopenJsh.run_jsh(ECHO, "echo", params)
+        assert not p.args[1].startswith(jshlib.ARGV_JSH_REQUEST + '=')
+
+        outputs, logs = p.communicate()
+        assert [jshlib.request("echo", params)] == logs
+        assert 0 == p.returncode
+
+    def test_netstring_framing(self):
+        inputs = [{"a": "☃"}, [1, 2], 3]
+        p = jshlib.PopenJsh.run_jsh(ECHO, "echo",
+                                    framing=jshlib.FRAMING_NETSTRING)
+        assert "--jsh-framing=netstring" == p.args[-1]
+        outputs, logs = p.communicate(inputs)
+        assert inputs == outputs
+        assert [jshlib.request("echo")] == logs
+
+        stdout = subprocess.check_output(p.args, input=b'[1]\n')
+        assert b'3:[1],' == stdout
+
+    def test_stats(self):
+        stats = jshlib.CallStats()
+        returncode, outputs, logs = jshlib.run_jsh(
+            ECHO, "echo", inputs=[{"a": 1}, {"b": 2}], stats=stats)
+        assert 0 == returncode
+
+        assert "echo" == stats.method
+        assert 0 == stats.returncode
+        assert 0 <= stats.spawn_s <= stats.wall_s
+        out = stats.streams[jshlib.OUT]
+        assert 2 == out.records
+        assert len(b'{"a":1}\n{"b":2}\n') <= out.bytes
+        assert 0 < out.first_record_s <= stats.wall_s
+        assert 1 == stats.streams[jshlib.LOG].records
+        if hasattr(os, 'wait4'):
+            assert stats.user_s is not None and stats.max_rss_kb > 0
+
+        data = json.loads(json.dumps(stats.serialize()))
+        assert 2 == data["streams"]["out"]["records"]
+
+    def test_stats_poll(self):
+        stats = jshlib.CallStats()
+        p = jshlib.PopenJsh.run_jsh(ECHO, "echo", stats=stats)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            p.wait(timeout=0.05)
+
+        p.stdin.close()
+        while p.poll() is None:
+            time.sleep(0.01)
+        p.stdout.close()
+        p.stderr.close()
+        assert 0 == stats.returncode == p.wait()
+        if hasattr(os, 'wait4'):
+            assert stats.user_s is not None and stats.max_rss_kb > 0
+
+    @unittest.skipUnless(hasattr(os, 'wait4'), "reaped by Popen")
+    def test_stats_poll_threads(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        cmd = os.path.join(tmp, "exit3")
+        with open(cmd, "w") as f:
+            f.write("#!/bin/sh\nexit 3\n")
+        os.chmod(cmd, 0o755)
+        polled = []
+
+        class Stats(jshlib.CallStats):
+            def rusage(self, rusage):
+                # poll from another thread while the process is being reaped
+                thread = threading.Thread(
+                    target=lambda: polled.append(p.poll()))
+                thread.start()
+                thread.join()
+                super(Stats, self).rusage(rusage)
+
+        p = jshlib.PopenJsh.run_jsh(cmd,
+                                    "exit3",
+                                    stdin=None,
+                                    stdout=None,
+                                    stderr=None,
+                                    stats=Stats())
+        while p.poll() is None:
+            time.sleep(0.01)
+        assert [None] == polled
+        assert 3 == p.returncode == p.stats.returncode
+
+    def test_stats_env(self):
+        os.environ[jshlib.STATS_ENV] = "1"
+        try:
+            p = jshlib.PopenJsh.run_jsh(ECHO, "echo")
+        finally:
+            del os.environ[jshlib.STATS_ENV]
+        assert p.stats.log
+        p.stats.log = False
+        p.communicate()
+        assert 0 == p.stats.returncode
+
+
+class TestLimits(unittest.TestCase):
+    def assert_limit(self, logs, limit, value):
+        err = logs[-1]
+        assert isinstance(err, jshlib.Error)
+        assert jshlib.Error.LIMIT_EXCEEDED == err.code
+        assert limit == err.data["limit"]
+        assert value == err.data["value"]
+
+    def test_timeout(self):
+        # echo blocks reading a stdin which is never closed
+        r, w = os.pipe()
+        self.addCleanup(os.close, w)
+        start = time.monotonic()
+        p = jshlib.PopenJsh.run_jsh(ECHO, "echo", stdin=r, timeout=0.2)
+        os.close(r)
+        outputs, logs = p.communicate()
+        assert time.monotonic() - start < 5
+        assert [] == outputs
+        assert jshlib.request("echo") == logs[0]
+        self.assert_limit(logs, "timeout", 0.2)
+        assert p.limit_error is logs[-1]
+        assert p.returncode < 0
+
+    def test_timeout_after_close(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        cmd = os.path.join(tmp, "closed")
+        with open(cmd, "w") as f:
+            f.write("#!/bin/sh\nexec >&- 2>&-\nexec sleep 600\n")
+        os.chmod(cmd, 0o755)
+
+        start = time.monotonic()
+        p = jshlib.PopenJsh.run_jsh(cmd, "closed", timeout=0.3)
+        _, logs = p.communicate()
+        assert time.monotonic() - start < 5
+        self.assert_limit(logs, "timeout", 0.3)
+        assert p.returncode < 0
+
+    def test_max_records(self):
+        inputs = [{"i": i} for i in range(100)]
+        rc, outputs, logs = jshlib.run_jsh(ECHO, "echo", inputs=inputs,
+                                           max_records=10)
+        assert inputs[:10] == outputs
+        self.assert_limit(logs, "max_records", 10)
+        assert rc != 0
+
+        p = jshlib.PopenJsh.run_jsh(ECHO, "echo")
+        outputs, logs = p.communicate(inputs, max_records=100)
+        assert inputs == outputs and p.limit_error is None
+
+    def test_max_output_bytes(self):
+        inputs = [{"pad": "x" * 1000} for _ in range(100)]
+        rc, outputs, logs = jshlib.run_jsh(ECHO, "echo", inputs=inputs,
+                                           max_output_bytes=5500)
+        assert inputs[:5] == outputs
+        self.assert_limit(logs, "max_output_bytes", 5500)
+        assert rc != 0
+
+    def test_rlimit(self):
+        with self.assertRaises(ValueError):
+            jshlib.PopenJsh.run_jsh(ECHO, "echo", rlimit={"unknown": 1})
+        rc, outputs, _ = jshlib.run_jsh(ECHO, "echo", inputs=[1],
+                                        rlimit={"cpu": 10, "nofile": 64})
+        assert (0, [1]) == (rc, outputs)
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        spin = os.path.join(tmp, "spin")
+        with open(spin, "w") as f:
+            f.write("#!/bin/sh\nwhile :; do :; done\n")
+        os.chmod(spin, 0o755)
+        rc, _, logs = jshlib.run_jsh(spin, "spin", rlimit={"cpu": 1})
+        self.assert_limit(logs, "cpu", 1)
+        assert rc < 0
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = jshlib.ResultCache(os.path.join(self.tmp, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_cached(self):
+        params = {"b": 1, "a": [1, 2]}
+        expected = (0, ["foo", {"x": 1}], [jshlib.request("echo", params)])
+        inputs = ["foo", {"x": 1}]
+        result = jshlib.run_jsh(ECHO, "echo", params, inputs, cache=self.cache)
+        assert expected == result
+
+        key = self.cache.key(ECHO, "echo", {"a": [1, 2], "b": 1}, inputs)
+        assert expected == self.cache.get(key)
+        assert expected == jshlib.run_jsh(ECHO,
+                                          "echo",
+                                          params,
+                                          iter(inputs),
+                                          cache=self.cache)
+
+        assert key != self.cache.key(ECHO, "echo", params, ["bar"])
+        assert key != self.cache.key(ECHO, "other", params, inputs)
+
+    def test_cmd_changed(self):
+        cmd = os.path.join(self.tmp, 'echo')
+        shutil.copy(ECHO, cmd)
+        key = self.cache.key(cmd, "echo")
+        os.utime(cmd, (0, 0))
+        assert key != self.cache.key(cmd, "echo")
+
+        cache = jshlib.ResultCache(self.cache.path, hash_cmd=True)
+        key = cache.key(cmd, "echo")
+        os.utime(cmd, None)
+        assert key == cache.key(cmd, "echo")
+
+    def test_impure(self):
+        cache = jshlib.ResultCache(self.cache.path, impure=["echo"])
+        result = jshlib.run_jsh(ECHO, "echo", inputs=[1], cache=cache)
+        assert (0, [1], [jshlib.request("echo")]) == result
+        assert not os.path.exists(self.cache.path)
+
+    def test_evict(self):
+        cache = jshlib.ResultCache(self.cache.path, max_bytes=4000)
+        value = "x" * 900
+        for i in range(10):
+            cache.put(str(i) * 8, (0, [value], []))
+            os.utime(cache._entry(str(i) * 8), (i, i))
+
+        assert None is cache.get("0" * 8)
+        assert (0, [value], []) == cache.get("9" * 8)
+        assert 4000 >= sum(e[1] for e in cache._entries())
+
+    def test_overwrite(self):
+        cache = jshlib.ResultCache(self.cache.path, max_bytes=4000)
+        for _ in range(10):
+            cache.put("1" * 8, (0, ["x" * 900], []))
+        cache.put("2" * 8, (0, ["x" * 900], []))
+
+        # an overwritten entry is only counted once, nothing is evicted
+        assert (0, ["x" * 900], []) == cache.get("1" * 8)
+        assert sum(e[1] for e in cache._entries()) == cache._size
+
+
+class TestIterRecords(unittest.TestCase):
+    def test_echo(self):
+        request = jshlib.Request("echo", {"testing": "true"})
+        p = jshlib.PopenJsh.run_jsh(ECHO, request.method, request.params)
+        records = list(p.iter_records(inputs=["foo", {"bar": 1}]))
+
+        outputs = [v for kind, v in records if kind == jshlib.OUT]
+        logs = [v for kind, v in records if kind == jshlib.LOG]
+        assert ["foo", {"bar": 1}] == outputs
+        assert [request.serialize()] == logs
+        assert 0 == p.returncode
+
+    def test_no_deadlock(self):
+        # much larger than the pipe buffers in both directions
+        inputs = [{"index": i, "pad": "x" * 100} for i in range(20000)]
+        p = jshlib.PopenJsh.run_jsh(ECHO, "echo")
+        outputs = [
+            v for kind, v in p.iter_records(inputs=inputs)
+            if kind == jshlib.OUT
+        ]
+        assert inputs == outputs
+        assert 0 == p.returncode
+
+
+class TestRecordFilters(unittest.TestCase):
+    def test_communicate(self):
+        inputs = [{"i": i, "even": i % 2 == 0} for i in range(100)]
+        p = jshlib.PopenJsh.run_jsh(ECHO, "echo")
+        outputs, logs = p.communicate(inputs,
+                                      fields=["i"],
+                                      where=lambda r: r["even"],
+                                      log_where={"lvl": "ERROR"})
+
+        assert [{"i": i} for i in range(0, 100, 2)] == outputs
+        assert [] == logs
+        assert 0 == p.returncode
+
+
+class TestRunJshMany(unittest.TestCase):
+    def test_ordered(self):
+        calls = [(ECHO, "echo", {"i": i}, [i]) for i in range(6)]
+        results = list(jshlib.run_jsh_many(calls, max_workers=3,
+                                           ordered=True))
+
+        expected = [(i, 0, [i], [jshlib.request("echo", {"i": i})])
+                    for i in range(6)]
+        assert expected == results
+
+    def test_unordered_kwargs(self):
+        calls = ({"cmd": ECHO, "method": "echo", "inputs": [i]}
+                 for i in range(4))
+        results = list(jshlib.run_jsh_many(calls, max_workers=2))
+
+        assert [0, 1, 2, 3] == sorted(r[0] for r in results)
+        for index, rc, outputs, _ in results:
+            assert 0 == rc
+            assert [index] == outputs
+
+    def test_fail_fast(self):
+        calls = [(ECHO, "echo")] * 20
+        calls[1] = ("false", "fail")
+        results = list(jshlib.run_jsh_many(calls, max_workers=2,
+                                           fail_fast=True))
+
+        index, rc, _, _ = results[-1]
+        assert 1 == index
+        assert 0 != rc
+        assert len(results) < len(calls)
+
+    def test_fail_fast_ordered(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        slow = os.path.join(tmp, "slow")
+        fail = os.path.join(tmp, "fail")
+        for path, script in ((slow, "exec sleep 10"),
+                             (fail, "sleep 0.3; exit 3")):
+            with open(path, "w") as f:
+                f.write("#!/bin/sh\n" + script + "\n")
+            os.chmod(path, 0o755)
+
+        calls = [(slow, "slow"), (ECHO, "echo", None, [1]), (fail, "fail"),
+                 (ECHO, "echo")]
+        start = time.time()
+        results = list(jshlib.run_jsh_many(calls, max_workers=3,
+                                           ordered=True, fail_fast=True))
+
+        # the finished call before the failure is not dropped, the slow one
+        # is killed and the last call is never started
+        assert [(1, 0), (2, 3)] == [r[:2] for r in results]
+        assert time.time() - start < 5
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_call(self):
+        with jshlib.WorkerPool(ECHO, size=2) as pool:
+            assert {"a": 1} == pool.call("echo", {"a": 1})
+            assert "x" * 100000 == pool.call("echo", "x" * 100000)
+            assert [pool.call("echo", [i]) for i in range(50)] \
+                == [[i] for i in range(50)]
+
+            with self.assertRaises(jshlib.Error) as cm:
+                pool.call("fail", {"b": 2})
+            assert 42 == cm.exception.code
+            assert {"b": 2} == cm.exception.data
+
+    def test_threads(self):
+        results = {}
+
+        def call_some(pool, start):
+            for i in range(start, start + 20):
+                results[i] = pool.call("echo", [i])
+
+        with jshlib.WorkerPool(ECHO, size=3) as pool:
+            threads = [
+                threading.Thread(target=call_some, args=(pool, start))
+                for start in range(0, 100, 20)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        assert {i: [i] for i in range(100)} == results
+
+
+class TestStreamingInputs(unittest.TestCase):
+    def test_generator_is_lazy(self):
+        total = 50000
+        produced = []
+
+        def inputs():
+            for i in range(total):
+                produced.append(i)
+                yield i
+
+        p = jshlib.PopenJsh.run_jsh(ECHO, "echo")
+        count = 0
+        for kind, value in p.iter_records(inputs=inputs()):
+            if kind == jshlib.OUT:
+                if count == 0:
+                    # the process started working before all inputs existed
+                    assert len(produced) < total
+                assert count == value
+                count += 1
+
+        assert total == count
+        assert 0 == p.returncode
+
+    def test_communicate_generator(self):
+        p = jshlib.PopenJsh.run_jsh(ECHO, "echo")
+        outputs, logs = p.communicate(inputs=(str(i) for i in range(5000)))
+        assert [str(i) for i in range(5000)] == outputs
+        assert [jshlib.request("echo")] == logs
+
+
+class TestPipeline(unittest.TestCase):
+    def test_echo_chain(self):
+        stages = [(ECHO, "echo", {"stage": i}) for i in range(3)]
+        p = jshlib.pipeline(stages, inputs=({"i": i} for i in range(1000)))
+        outputs, logs = p.communicate()
+
+        assert [{"i": i} for i in range(1000)] == outputs
+        assert [(i, jshlib.request("echo", {"stage": i}))
+                for i in range(3)] == sorted(logs, key=lambda l: l[0])
+        assert [0, 0, 0] == p.returncodes
+
+    def test_failing_stage(self):
+        p = jshlib.pipeline([(ECHO, "echo"), ("false", "fail")],
+                            inputs=range(10))
+        records = list(p.iter_records())
+
+        # echo may also log a broken pipe, depending on timing
+        assert [] == [r for r in records if r[1] == jshlib.OUT]
+        assert (0, jshlib.LOG, jshlib.request("echo")) == records[0]
+        assert 1 == p.returncodes[1]
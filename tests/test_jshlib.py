@@ -1,6 +1,15 @@
 from __future__ import unicode_literals
-import unittest
+import os
 import io
+import sys
+import json
+import time
+import pickle
+import tempfile
+import pathlib
+import subprocess
+import importlib.util
+import unittest
 
 import jshlib
 
@@ -72,3 +81,773 @@ class TestLoadJsh(unittest.TestCase):
             },
         ]
         assert expected == result
+
+    def test_chunk_boundaries(self):
+        data = '[1, 2] 42 "a b"\n{"x": {"y": [3.5, -7]}} 1234 true null'
+        expected = list(jshlib.load_json_iter(data))
+        assert [[1, 2], 42, "a b", {"x": {"y": [3.5, -7]}}, 1234, True,
+                None] == expected
+        for size in (1, 2, 3, 7):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            result = list(jshlib.load_json_iter(chunks))
+            assert expected == result
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            list(jshlib.load_json_iter('{"one": 1} {"two": '))
+
+    def test_streamed_record(self):
+        # a value is yielded as soon as its end arrives
+        record = json.dumps({"a": "x" * 100000}) + '\n'
+
+        def chunks():
+            yield record[:60000]
+            yield record[60000:]
+            raise AssertionError("read past the record")
+
+        assert {"a": "x" * 100000} == next(jshlib.load_json_iter(chunks()))
+
+
+LEGACY_DIGITS = {str(n) for n in range(10)}
+LEGACY_DIGITS.add('.')
+LEGACY_CURLY = {'{', '}'}
+LEGACY_BRACKET = {'[', ']'}
+
+
+def _legacy_load_json_iter(stream):
+    for slist in _legacy_load_json_striter(stream):
+        yield json.loads(''.join(slist))
+
+
+# pylint: disable=too-many-statements
+# pylint: disable=too-many-branches
+def _legacy_load_json_striter(stream):
+    """The per-character scanner load_json_iter used before raw decoding."""
+    alltext = []
+
+    ignore_next = False
+    open_curly = False
+    open_bracket = False
+    open_string = False
+    is_digits = False
+    brackets = 0
+
+    def consolodate_result(alltext, text, i):
+        """Consolodate the result into alltext and return what was excluded."""
+        include, text = text[:i + 1], text[i + 1:]
+        alltext.append(include)
+        return text, 0
+
+    for text in stream:
+        i = 0
+        while i < len(text):
+            c = text[i]
+
+            if ignore_next:
+                ignore_next = False
+            elif c == '\\':
+                ignore_next = True
+            elif is_digits is True and c not in LEGACY_DIGITS:
+                # We found a Number
+                text, i = consolodate_result(alltext, text, i)
+                yield alltext
+                alltext = []
+                is_digits = False
+                continue
+            elif c == '"':
+                if not (open_curly or open_bracket):
+                    if open_string:
+                        # We found a String
+                        text, i = consolodate_result(alltext, text, i)
+                        yield alltext
+                        alltext = []
+                        open_string = False
+                        continue
+
+                open_string = not open_string
+
+            elif c in LEGACY_DIGITS and not (open_string or open_bracket
+                                       or open_curly):
+                is_digits = True
+
+            elif c in LEGACY_BRACKET and not (open_string or open_curly):
+                if c == '[':
+                    open_bracket = True
+                    brackets += 1
+                elif c == ']':
+                    brackets -= 1
+                    if brackets == 0:
+                        # We found a List
+                        text, i = consolodate_result(alltext, text, i)
+                        yield alltext
+                        alltext = []
+                        open_bracket = False
+                        continue
+
+            elif c in LEGACY_CURLY and not (open_string or open_bracket):
+                if c == '{':
+                    open_curly = True
+                    brackets += 1
+                elif c == '}':
+                    brackets -= 1
+                    if brackets == 0:
+                        # We found an Object
+                        text, i = consolodate_result(alltext, text, i)
+                        yield alltext
+                        alltext = []
+                        open_curly = False
+                        continue
+
+            i += 1
+
+        if text.strip():
+            alltext.append(text)
+
+    if alltext:
+        yield alltext
+
+
+class TestLoadJshThroughput(unittest.TestCase):
+    """Compare against the legacy scanner.
+
+    Set JSH_THROUGHPUT_MB=100 to run on a 100 MB NDJSON file.
+    """
+    def test_order_of_magnitude(self):
+        size = int(float(os.environ.get('JSH_THROUGHPUT_MB', '1')) * 1e6)
+        fd, path = tempfile.mkstemp(suffix='.ndjson')
+        try:
+            with io.open(fd, 'w', encoding='utf-8') as f:
+                written = i = 0
+                while written < size:
+                    written += f.write(json.dumps(_log_record(i)) + '\n')
+                    i += 1
+
+            legacy = _time_load(_legacy_load_json_iter, path)
+            new = _time_load(jshlib.load_json_iter, path)
+        finally:
+            os.remove(path)
+
+        assert legacy[1] == new[1] == i
+        assert legacy[0] >= 10 * new[0], (legacy[0], new[0])
+
+
+def _log_record(i):
+    return {
+        "lvl": "INFO",
+        "msg": "compiled src/module_{0}/source_{0}.c with -O2 -g -Wall "
+        "-Wextra -fPIC -Iinclude into build/obj/module_{0}.o".format(i),
+        "data": {
+            "size": i * 13,
+            "elapsed": i / 7.0,
+        },
+    }
+
+
+def _time_load(load, path):
+    with io.open(path, encoding='utf-8') as f:
+        start = time.process_time()
+        count = sum(1 for _ in load(f))
+        return time.process_time() - start, count
+
+
+
+class TestLoadJshBytes(unittest.TestCase):
+    DATA = '{"name": "café ☃"} [1, 2] 42 "\U0001f600"\n'
+    EXPECTED = [{"name": "café ☃"}, [1, 2], 42, "\U0001f600"]
+
+    def setUp(self):
+        self.chunk_size = jshlib.CHUNK_SIZE
+        # split multi-byte characters and records across chunks
+        jshlib.CHUNK_SIZE = 3
+
+    def tearDown(self):
+        jshlib.CHUNK_SIZE = self.chunk_size
+
+    def test_bytes_like(self):
+        data = self.DATA.encode('utf-8')
+        for value in (data, bytearray(data), memoryview(data)):
+            result = list(jshlib.load_json_iter(value))
+            assert self.EXPECTED == result
+
+    def test_binary_stream(self):
+        data = io.BytesIO(self.DATA.encode('utf-8'))
+        result = list(jshlib.load_json_iter(data))
+        assert self.EXPECTED == result
+
+    def test_path(self):
+        fd, path = tempfile.mkstemp(suffix='.ndjson')
+        try:
+            with io.open(fd, 'wb') as f:
+                f.write(self.DATA.encode('utf-8'))
+            result = list(jshlib.load_json_iter(pathlib.Path(path)))
+        finally:
+            os.remove(path)
+        assert self.EXPECTED == result
+
+    def test_empty_path(self):
+        fd, path = tempfile.mkstemp(suffix='.ndjson')
+        os.close(fd)
+        try:
+            result = list(jshlib.load_json_iter(pathlib.Path(path)))
+        finally:
+            os.remove(path)
+        assert [] == result
+
+
+class TestServe(unittest.TestCase):
+    def test_dispatch(self):
+        methods = {
+            "add": lambda params: params["a"] + params["b"],
+            "boom": lambda params: 1 / 0,
+        }
+        requests = [
+            dict(jshlib.request("add", {"a": 1, "b": 2}), id=1),
+            dict(jshlib.request("add", {"a": 1, "b": 2})),
+            dict(jshlib.request("missing"), id="two"),
+            dict(jshlib.request("boom"), id=3),
+            {"id": 4},
+        ]
+        stdin = io.StringIO('\n'.join(json.dumps(r) for r in requests))
+        stdout = io.StringIO()
+
+        assert 0 == jshlib.serve(methods, stdin=stdin, stdout=stdout)
+
+        responses = list(jshlib.load_json_iter(stdout.getvalue()))
+        assert jshlib.response(3, 1) == responses[0]
+        assert ["two", 3, 4] == [r[jshlib.ID] for r in responses[1:]]
+        codes = [r[jshlib.RPC_ERROR][jshlib.CODE] for r in responses[1:]]
+        assert [
+            jshlib.Error.METHOD_NOT_FOUND,
+            jshlib.Error.INTERNAL_ERROR,
+            jshlib.Error.INVALID_REQUEST,
+        ] == codes
+
+    def test_invalid(self):
+        methods = {"echo": lambda params: params}
+        stdin = io.BytesIO(b'{"jsonrpc": "2.0", "method": \n'
+                           b'[]\n'
+                           b'{"jsonrpc": "2.0", "method": "echo", "id": 1}\n')
+        stdout = io.StringIO()
+
+        assert 0 == jshlib.serve(methods, stdin=stdin, stdout=stdout)
+
+        responses = list(jshlib.load_json_iter(stdout.getvalue()))
+        assert [None, None] == [r[jshlib.ID] for r in responses[:2]]
+        assert [
+            jshlib.Error.PARSE_ERROR,
+            jshlib.Error.INVALID_REQUEST,
+        ] == [r[jshlib.RPC_ERROR][jshlib.CODE] for r in responses[:2]]
+        assert jshlib.response(None, 1) == responses[2]
+
+
+class TestBatch(unittest.TestCase):
+    def test_request_id(self):
+        req = jshlib.parse_jsh_request(
+            json.dumps(jshlib.request("foo", {"a": 1}, id=7)))
+        assert ("foo", {"a": 1}, 7) == (req.method, req.params, req.id)
+        assert jshlib.request("foo", {"a": 1}, id=7) == req.serialize()
+
+    def test_parse_batch(self):
+        batch = jshlib.request_batch([
+            jshlib.Request("one", id=1),
+            ("two", {"b": 2}, 2),
+            ("three", ),
+        ])
+        argv = ["tool", "--jsh-request={}".format(json.dumps(batch))]
+        reqs = jshlib.parse_jsh_argv(argv)
+
+        assert [("one", None, 1), ("two", {"b": 2}, 2), ("three", None, None)] \
+            == [(r.method, r.params, r.id) for r in reqs]
+
+        with self.assertRaises(ValueError):
+            jshlib.parse_jsh_request("[]")
+
+    def test_dump_responses(self):
+        methods = {"square": lambda params: params[0]**2}
+        reqs = [jshlib.Request("square", [i], id=i) for i in range(20)]
+        reqs.append(jshlib.Request("square", [1]))
+        reqs.append(jshlib.Request("missing", id="m"))
+
+        for ordered, max_workers in ((True, 1), (True, 4), (False, 4)):
+            stdout = io.StringIO()
+            rc = jshlib.dump_responses(methods,
+                                       reqs,
+                                       ordered=ordered,
+                                       max_workers=max_workers,
+                                       stdout=stdout)
+            responses = list(jshlib.load_json_iter(stdout.getvalue()))
+
+            assert 1 == rc
+            assert 21 == len(responses)
+            results = {r[jshlib.ID]: r.get(jshlib.RESULT) for r in responses}
+            assert {i: i**2 for i in range(20)} == \
+                {k: v for k, v in results.items() if k != "m"}
+            if ordered:
+                assert list(range(20)) + ["m"] == \
+                    [r[jshlib.ID] for r in responses]
+
+
+class TestLoadJshFilter(unittest.TestCase):
+    LOGS = [{"lvl": "INFO" if i % 3 else "ERROR", "msg": "m{}".format(i)}
+            for i in range(30)]
+
+    def test_fields(self):
+        text = "\n".join(json.dumps(r) for r in self.LOGS) + "\n[1]"
+        result = list(jshlib.load_json_iter(text, fields=["msg", "missing"]))
+        assert [{"msg": r["msg"]} for r in self.LOGS] + [[1]] == result
+
+    def test_where(self):
+        text = "\n".join(json.dumps(r) for r in self.LOGS)
+        expected = [r for r in self.LOGS if r["lvl"] == "ERROR"]
+
+        assert expected == list(
+            jshlib.load_json_iter(text, where={"lvl": "ERROR"}))
+        assert expected == list(
+            jshlib.load_json_iter(text,
+                                  where=lambda r: r["lvl"] == "ERROR"))
+        assert self.LOGS == list(
+            jshlib.load_json_iter(text, where={"lvl": {"ERROR", "INFO"}}))
+
+    def test_where_chunked(self):
+        text = "\n".join(json.dumps(r) for r in self.LOGS)
+        expected = [{"msg": r["msg"]} for r in self.LOGS
+                    if r["lvl"] == "ERROR"]
+        for size in (1, 7, 64):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            assert expected == list(
+                jshlib.load_json_iter(chunks,
+                                      fields=["msg"],
+                                      where={"lvl": "ERROR"})), size
+
+    def test_where_not_skipped(self):
+        # escaped, non-ascii and multi-line records are decoded to be checked
+        text = (
+            '{"lvl": "INFO",\n "x": {"lvl": "ERROR"}}\n'
+            '{"lvl": "ERR\\u004fR"}\n'
+            '{"lvl": "\u00e9"}\n'
+            '{"lvl":\n"ERROR"}\n'
+            '"ERROR"\n')
+        result = list(
+            jshlib.load_json_iter(text, where={"lvl": {"ERROR", "\u00e9"}}))
+        assert [{"lvl": "ERROR"}, {"lvl": "\u00e9"}, {"lvl": "ERROR"}] \
+            == result
+
+
+class TestParseJshArgv(unittest.TestCase):
+    def test_request_file(self):
+        req = jshlib.request("echo", {"a": 1})
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            f.write(json.dumps(req).encode('utf-8'))
+        try:
+            argv = ["cmd", "{}={}".format(jshlib.ARGV_JSH_REQUEST_FILE, f.name)]
+            result = jshlib.parse_jsh_argv(argv)
+        finally:
+            os.remove(f.name)
+
+        assert req == result.serialize()
+
+    def test_request_fd(self):
+        req = jshlib.request("echo", {"a": 1})
+        r, w = os.pipe()
+        os.write(w, json.dumps(req).encode('utf-8'))
+        os.close(w)
+
+        argv = ["cmd", "{}={}".format(jshlib.ARGV_JSH_REQUEST_FD, r)]
+        assert req == jshlib.parse_jsh_argv(argv).serialize()
+
+    def test_unreadable(self):
+        argv = ["cmd", jshlib.ARGV_JSH_REQUEST_FILE + "=/does/not/exist"]
+        with self.assertRaises(ValueError):
+            jshlib.parse_jsh_argv(argv)
+
+
+class TestRecordWriter(unittest.TestCase):
+    def test_binary_max_records(self):
+        stream = io.BytesIO()
+        writer = jshlib.RecordWriter(stream, max_records=2)
+        writer.write({"a": "☃"})
+        assert b'' == stream.getvalue()
+        writer.write(jshlib.Request("foo"))
+        expected = [{"a": "☃"}, jshlib.request("foo")]
+        assert expected == list(jshlib.load_json_iter(stream.getvalue()))
+
+    def test_max_bytes_and_write_many(self):
+        stream = io.StringIO()
+        with jshlib.RecordWriter(stream, max_bytes=100) as writer:
+            writer.write_many(range(10), batch_size=3)
+            assert '' == stream.getvalue()
+            writer.write_many([[jshlib.Request("m", id=i)] for i in range(5)])
+            assert stream.getvalue()
+        values = list(jshlib.load_json_iter(stream.getvalue()))
+        assert list(range(10)) + \
+            [[jshlib.request("m", id=i)] for i in range(5)] == values
+
+    def test_always_and_delay(self):
+        for kwargs in ({"always": True}, {"max_delay": 0}):
+            stream = io.StringIO()
+            writer = jshlib.RecordWriter(stream, **kwargs)
+            writer.write(1)
+            assert '1\n' == stream.getvalue()
+
+    def test_dump_stdout_redirected(self):
+        stdout = sys.stdout
+        sys.stdout = stream = io.StringIO()
+        try:
+            jshlib.dump_stdout({"a": 1})
+            jshlib.stdout_writer().flush()
+        finally:
+            sys.stdout = stdout
+        assert [{"a": 1}] == list(jshlib.load_json_iter(stream.getvalue()))
+
+
+class TestRequestTemplate(unittest.TestCase):
+    def test_encode(self):
+        for method in ("build", "☃ \"quoted\""):
+            template = jshlib.RequestTemplate.get(method)
+            assert template is jshlib.RequestTemplate.get(method)
+            for params in (None, {}, [], {"a": [1, "☃"]}, [1, 2]):
+                for id in (None, 0, 7, "x", True, 1.5):
+                    expected = jshlib.request(method, params, id)
+                    text = template.encode(params, id)
+                    assert jshlib.get_codec().dumps(expected) == text
+                    request = jshlib.Request(method, params, id)
+                    assert text == request.encode()
+
+    def test_codec(self):
+        codec = jshlib.get_codec()
+        self.addCleanup(jshlib.set_codec, codec.name)
+        for name in jshlib.available_codecs():
+            jshlib.set_codec(name)
+            template = jshlib.RequestTemplate.get("m")
+            assert jshlib.get_codec() is template.codec
+            expected = jshlib.request("m", {"a": [1, 2]}, "x")
+            assert jshlib.get_codec().dumps(expected) == template.encode(
+                {"a": [1, 2]}, "x"), name
+
+    def test_record_writer(self):
+        stream = io.StringIO()
+        with jshlib.RecordWriter(stream) as writer:
+            writer.write(jshlib.Request("m", {"a": 1}, 3))
+            writer.write([jshlib.Request("n")])
+        assert [jshlib.request("m", {"a": 1}, 3),
+                [jshlib.request("n")]] == list(
+                    jshlib.load_json_iter(stream.getvalue()))
+
+    def test_slots(self):
+        for obj in (jshlib.Request("m"), jshlib.LogRecord("msg")):
+            assert not hasattr(obj, '__dict__'), obj
+        # exceptions always have a (lazy) __dict__
+        assert {} == jshlib.Error(1, "msg", None).__dict__
+
+        record = jshlib.LogRecord("msg", data={"a": 1})
+        assert jshlib.log_payload("msg", data={"a": 1}) == record.serialize()
+
+        err = pickle.loads(pickle.dumps(jshlib.Error(1, "msg", [2])))
+        assert (1, "msg", [2]) == (err.code, err.message, err.data)
+
+
+class TestCodecs(unittest.TestCase):
+    def setUp(self):
+        self.codec = jshlib.get_codec()
+
+    def tearDown(self):
+        jshlib.set_codec(self.codec.name)
+
+    def test_available(self):
+        names = jshlib.available_codecs()
+        assert 'json' in names
+        if not os.environ.get(jshlib.JSON_CODEC_ENV):
+            assert names[0] == jshlib.set_codec().name
+        with self.assertRaises(ValueError):
+            jshlib.load_codec('yaml')
+
+    def test_every_codec(self):
+        value = {
+            "str": "café ☃ / \"quoted\"",
+            "int": 2**70,
+            "float": 2.5,
+            "list": [True, False, None, -3],
+            "req": jshlib.Request("m", [1], id=3),
+        }
+        expected = dict(value, req=jshlib.request("m", [1], id=3))
+        mixed = '1 2\n{"a":\n [1, 2]}\n\n"s"\n  3\n[4]'
+
+        for name in jshlib.available_codecs():
+            codec = jshlib.set_codec(name)
+            encoded = codec.dumps(value)
+            assert expected == codec.loads(encoded), name
+            assert expected == json.loads(encoded), name
+
+            stream = '\n'.join([encoded] * 3) + '\n'
+            assert [expected] * 3 == list(jshlib.load_json_iter(stream))
+            assert [1, 2, {"a": [1, 2]}, "s", 3, [4]] \
+                == list(jshlib.load_json_iter(mixed.splitlines(True))), name
+
+
+class TestJsonStreamParser(unittest.TestCase):
+    VALUES = [
+        {"a": "x\\\"y", "b": [1, 2, {"c": "☃ \"}]"}]},
+        "str \\ \" ]",
+        -12.5e3,
+        True,
+        None,
+        [[]],
+        {},
+        0,
+        1.5e-7,
+    ]
+
+    def test_any_split(self):
+        for sep in ('\n', ' ', '\n\n  '):
+            text = sep.join(json.dumps(v) for v in self.VALUES)
+            for data in (text, text.encode('utf-8')):
+                for size in (1, 2, 3, 5, 8, 13):
+                    parser = jshlib.JsonStreamParser()
+                    values = []
+                    for i in range(0, len(data), size):
+                        values.extend(parser.feed(data[i:i + size]))
+                    values.extend(parser.close())
+                    assert self.VALUES == values, (sep, size)
+
+    def test_split_fallback(self):
+        # values orjson rejects decode the same whole or split
+        text = '[NaN, 18446744073709551616]\n{"a": -Infinity}\n'
+        expected = json.dumps([json.loads(l) for l in text.splitlines()])
+        self.addCleanup(jshlib.set_codec, jshlib.get_codec().name)
+        for name in jshlib.available_codecs():
+            jshlib.set_codec(name)
+            for size in (1, 5, len(text)):
+                parser = jshlib.JsonStreamParser()
+                values = []
+                for i in range(0, len(text), size):
+                    values.extend(parser.feed(text[i:i + size]))
+                values.extend(parser.close())
+                assert expected == json.dumps(values), (name, size)
+
+    def test_partial_state(self):
+        parser = jshlib.JsonStreamParser()
+        assert [] == parser.feed('{"a": [1, "]')
+        assert [] == parser.feed('"]')
+        assert [{"a": [1, "]"]}] == parser.feed('}')
+        assert [] == parser.feed(' 12')
+        assert [123] == parser.feed('3\n')
+        assert [] == parser.close()
+
+    def test_error_offset(self):
+        data = '{"a": 1}\n{"b": ☃}\n'.encode('utf-8')
+        parser = jshlib.JsonStreamParser()
+        assert [{"a": 1}] == parser.feed(data[:12])
+        with self.assertRaises(jshlib.JsonStreamError) as cm:
+            parser.feed(data[12:])
+        assert 15 == cm.exception.offset
+
+        parser = jshlib.JsonStreamParser()
+        assert [[1, 2]] == parser.feed('[1, 2]\n{"a": [3, 4')
+        with self.assertRaises(ValueError) as cm:
+            parser.close()
+        assert 18 == cm.exception.offset
+
+        with self.assertRaises(jshlib.JsonStreamError) as cm:
+            jshlib.JsonStreamParser().feed('[1] ]')
+        assert 4 == cm.exception.offset
+
+    def test_stats(self):
+        data = b'{"a": 1}\n{"a": 2}\n[3]\n'
+        stats = jshlib.StreamStats()
+        values = list(jshlib.load_json_iter(io.BytesIO(data), stats=stats))
+        assert 3 == len(values) == stats.records
+        assert len(data) == stats.bytes
+        assert 0 < stats.parse_s <= stats.wall_s
+        assert stats.first_record_s is not None
+        assert stats.records_per_s > 0 and stats.bytes_per_s > 0
+
+        stats = jshlib.StreamStats()
+        list(jshlib.load_json_iter(data, where={"a": 2}, stats=stats))
+        assert 1 == stats.records
+
+
+class TestParallelLoad(unittest.TestCase):
+    VALUES = [{"i": i, "s": "☃" * (i % 4)} for i in range(3000)]
+    DATA = ''.join(json.dumps(v) + '\n' for v in VALUES).encode('utf-8')
+
+    def test_sources(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(self.DATA)
+        try:
+            for stream in (self.DATA, self.DATA.decode('utf-8'),
+                           io.BytesIO(self.DATA),
+                           io.StringIO(self.DATA.decode('utf-8')),
+                           pathlib.Path(f.name)):
+                values = jshlib.parallel_load(stream,
+                                              workers=2,
+                                              chunk_size=4096)
+                assert self.VALUES == list(values), type(stream)
+        finally:
+            os.remove(f.name)
+
+    def test_unordered_and_filters(self):
+        values = jshlib.parallel_load(self.DATA,
+                                      workers=3,
+                                      ordered=False,
+                                      chunk_size=1000)
+        assert self.VALUES == sorted(values, key=lambda v: v["i"])
+
+        values = jshlib.load_json_iter(self.DATA,
+                                       fields=["i"],
+                                       where={"s": "☃☃"},
+                                       workers=2)
+        assert [{"i": i} for i in range(2, 3000, 4)] == list(values)
+
+    def test_error_offset(self):
+        data = self.DATA + b'{"x": ]\n'
+        with self.assertRaises(jshlib.JsonStreamError) as cm:
+            list(jshlib.parallel_load(data, workers=2, chunk_size=4096))
+        assert len(self.DATA) + 6 == cm.exception.offset
+
+    def test_small(self):
+        assert [] == list(jshlib.parallel_load(b'', workers=2))
+        assert [1, 2] == list(jshlib.parallel_load(b'1\n2', workers=2))
+        assert [1, 2] == list(
+            jshlib.load_json_iter(io.StringIO("1\n2\n"), workers=2))
+
+    def test_stats(self):
+        for workers in (1, 2):
+            stats = jshlib.StreamStats()
+            stream = io.StringIO(self.DATA.decode('utf-8'))
+            values = jshlib.load_json_iter(stream,
+                                           stats=stats,
+                                           workers=workers)
+            assert self.VALUES == list(values)
+            assert len(self.VALUES) == stats.records
+            assert len(self.DATA) == stats.bytes, workers
+
+
+class TestNetstring(unittest.TestCase):
+    VALUES = [{"a": "☃ \"x\""}, 1, "x\ny", [1, [2]], 12, None, {}]
+    FRAMING = jshlib.FRAMING_NETSTRING
+
+    def framed(self):
+        stream = io.BytesIO()
+        with jshlib.RecordWriter(stream,
+                                 framing=jshlib.FRAMING_NETSTRING) as w:
+            w.write(self.VALUES[0])
+            w.write_many(self.VALUES[1:])
+        return stream.getvalue()
+
+    def test_writer(self):
+        data = self.framed()
+        expected = b''
+        for value in self.VALUES:
+            record = jshlib.get_codec().dumps(value).encode('utf-8')
+            expected += str(len(record)).encode() + b':' + record + b','
+        assert expected == data
+        assert data.endswith(b',2:12,4:null,2:{},')
+
+        stream = io.StringIO()
+        with jshlib.RecordWriter(stream,
+                                 framing=jshlib.FRAMING_NETSTRING) as w:
+            w.write_many(self.VALUES)
+        assert data == stream.getvalue().encode('utf-8')
+
+    def test_any_split(self):
+        data = self.framed()
+        for size in (1, 2, 3, 5, 8, 13, len(data)):
+            parser = jshlib.JsonStreamParser(
+                framing=jshlib.FRAMING_NETSTRING)
+            values = []
+            for i in range(0, len(data), size):
+                values.extend(parser.feed(data[i:i + size]))
+            values.extend(parser.close())
+            assert self.VALUES == values, size
+
+        assert self.VALUES == list(
+            jshlib.load_json_iter(data.decode('utf-8'), framing=self.FRAMING))
+        assert [{"a": "☃ \"x\""}] == list(
+            jshlib.load_json_iter(data,
+                                  where={"a": "☃ \"x\""},
+                                  framing=self.FRAMING))
+
+    def test_numbers_are_lines(self):
+        for framing in jshlib.FRAMINGS:
+            assert [12] == list(jshlib.load_json_iter(b'12', framing=framing))
+            assert [12, 3] == list(
+                jshlib.load_json_iter('12\n3', framing=framing))
+            assert [10**25, 5] == list(
+                jshlib.load_json_iter(str(10**25) + ' 5', framing=framing))
+
+    def test_not_negotiated(self):
+        # without the framing, leading digits are json and aren't held back
+        assert [] == jshlib.JsonStreamParser().feed('12')
+        assert [12] == jshlib.JsonStreamParser().feed('12\n')
+        with self.assertRaises(jshlib.JsonStreamError):
+            list(jshlib.load_json_iter(self.framed()))
+        with self.assertRaises(ValueError):
+            jshlib.JsonStreamParser(framing="unknown")
+
+    def test_errors(self):
+        for data, offset in ((b'3:12', 0), (b'2:[]]', 4), (b'1:1,x:1,', 4),
+                             (b'2:{},3:[1,2', 10)):
+            with self.assertRaises(jshlib.JsonStreamError) as cm:
+                list(jshlib.load_json_iter(data, framing=self.FRAMING))
+            assert offset == cm.exception.offset, data
+
+    def test_parse_jsh_framing(self):
+        argv = ["cmd", "--jsh-framing=netstring", '--jsh-request={"method": "m"}']
+        assert "m" == jshlib.parse_jsh_argv(argv).method
+        assert jshlib.FRAMING_NETSTRING == jshlib.parse_jsh_framing(argv)
+        assert jshlib.FRAMING_LINES == jshlib.stdout_writer().framing
+
+        argv[1] = "--jsh-framing=unknown"
+        assert jshlib.FRAMING_LINES == jshlib.parse_jsh_framing(argv)
+        assert jshlib.FRAMING_LINES == jshlib.parse_jsh_framing(["cmd"])
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "-X importtime is python3.7+")
+class TestImportTime(unittest.TestCase):
+    """jsh commands are often started once per request, so importing jshlib
+    must stay cheap."""
+    # import time of jshlib in microseconds, beyond that of json (which it
+    # always needs). It was about 20ms when subprocess and traceback were
+    # imported eagerly, and is about 5ms.
+    BUDGET_US = int(os.environ.get("JSH_IMPORT_BUDGET_US", 10000))
+
+    # modules which must only be imported when they are used
+    LAZY = ("subprocess", "threading", "select", "selectors", "signal",
+            "jshlib_process", "concurrent.futures", "tempfile", "traceback",
+            "shutil", "hashlib", "mmap", "queue", "jshlib_query", "orjson",
+            "ujson", "rapidjson")
+
+    def import_times(self, module="jshlib"):
+        """The fastest cumulative import time of each module over a few
+        runs of ``python -X importtime -c 'import <module>'``."""
+        env = dict(os.environ)
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        env.pop(jshlib.JSON_CODEC_ENV, None)  # it imports the backend
+        env["PYTHONPATH"] = os.path.dirname(os.path.abspath(jshlib.__file__))
+        args = [sys.executable, "-X", "importtime", "-c", "import " + module]
+
+        # the first run writes the bytecode cache
+        subprocess.check_output(args, env=env, stderr=subprocess.STDOUT)
+        cached = importlib.util.cache_from_source(jshlib.__file__)
+        if not os.path.exists(cached):
+            self.skipTest("jshlib's bytecode can't be cached")
+
+        times = {}
+        for _ in range(5):
+            stderr = subprocess.check_output(args,
+                                             env=env,
+                                             stderr=subprocess.STDOUT)
+            for line in stderr.decode("utf-8").splitlines()[1:]:
+                _, cumulative, name = line.split("|")
+                name = name.strip()
+                times[name] = min(int(cumulative),
+                                  times.get(name, float("inf")))
+        return times
+
+    def test_import_time(self):
+        times = self.import_times()
+        lazy = [name for name in self.LAZY if name in times]
+        assert [] == lazy, "imported when jshlib is imported"
+        json_us = self.import_times("json")["json"]
+        assert times["jshlib"] - json_us <= self.BUDGET_US, (times["jshlib"],
+                                                             json_us)
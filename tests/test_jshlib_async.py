@@ -0,0 +1,115 @@
+import os
+import asyncio
+import unittest
+
+import jshlib
+import jshlib_async
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+ECHO = os.path.join(TESTS, 'echo')
+
+
+def asyncio_run(coro):
+    """asyncio.run, which is python3.7+."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+async def agen(values):
+    for v in values:
+        await asyncio.sleep(0)
+        yield v
+
+
+class TestRunJshAsync(unittest.TestCase):
+    def test_echo_all(self):
+        request = jshlib.Request("echo", {"testing": "true"})
+        returncode, outputs, logs = asyncio_run(
+            jshlib_async.run_jsh_async(ECHO,
+                                       request.method,
+                                       request.params,
+                                       inputs=agen(["foo", [1, 2]])))
+
+        assert ["foo", [1, 2]] == outputs
+        assert [request.serialize()] == logs
+        assert 0 == returncode
+
+    def test_large_request(self):
+        params = {"files": ["some/long/file/path.c"] * 20000}
+        returncode, outputs, logs = asyncio_run(
+            jshlib_async.run_jsh_async(ECHO, "echo", params))
+
+        assert [jshlib.request("echo", params)] == logs
+        assert 0 == returncode
+
+    def test_many(self):
+        async def run_all():
+            calls = [
+                jshlib_async.run_jsh_async(ECHO, "echo", inputs=[i])
+                for i in range(10)
+            ]
+            return await asyncio.gather(*calls)
+
+        results = asyncio_run(run_all())
+        assert [(0, [i], [jshlib.request("echo")]) for i in range(10)] \
+            == results
+
+    def test_iter_records(self):
+        async def collect():
+            p = await jshlib_async.AsyncPopenJsh.run_jsh(ECHO, "echo")
+            records = [r async for r in p.iter_records(inputs=range(3))]
+            return p.returncode, records
+
+        returncode, records = asyncio_run(collect())
+        assert (jshlib.LOG, jshlib.request("echo")) in records
+        outputs = [v for kind, v in records if kind == jshlib.OUT]
+        assert [0, 1, 2] == outputs
+        assert 0 == returncode
+
+    def test_timeout_kills(self):
+        async def forever():
+            yield "first"
+            await asyncio.sleep(3600)
+
+        async def run():
+            p = await jshlib_async.AsyncPopenJsh.run_jsh(ECHO, "echo")
+            with self.assertRaises(asyncio.TimeoutError):
+                await p.communicate(inputs=forever(), timeout=0.5)
+            return p.returncode
+
+        returncode = asyncio_run(run())
+        assert returncode is not None
+        assert 0 != returncode
+
+    def test_exit_drops_inputs(self):
+        async def slow():
+            await asyncio.sleep(3600)
+            yield "never"
+
+        async def run():
+            p = await jshlib_async.AsyncPopenJsh.run_jsh("true", "echo")
+            outputs, logs = await p.communicate(inputs=slow(), timeout=5)
+            return p.returncode, outputs, logs
+
+        assert (0, [], []) == asyncio_run(run())
+
+    def test_close_kills(self):
+        async def forever():
+            yield "first"
+            await asyncio.sleep(3600)
+
+        async def run():
+            p = await jshlib_async.AsyncPopenJsh.run_jsh(ECHO, "echo")
+            # pylint: disable=protected-access
+            coro = p._communicate(forever(), None, None, None)
+            coro.send(None)
+            coro.close()
+            await asyncio.wait_for(p.process.wait(), 5)
+            return p.returncode
+
+        assert 0 != asyncio_run(run())
@@ -0,0 +1,69 @@
+import unittest
+
+import jshlib
+import jshlib_query
+
+
+class TestQuery(unittest.TestCase):
+    VALUE = {
+        "lvl": "ERROR",
+        "msg": "failed",
+        "data": {"files": ["a.c", "b.c", "c.c"], "n": None},
+        "with space": 1,
+    }
+
+    def check(self, expected, query, value=None):
+        result = jshlib_query.compile_query(query)(
+            self.VALUE if value is None else value)
+        assert expected == result, query
+
+    def test_paths(self):
+        files = self.VALUE["data"]["files"]
+        self.check([self.VALUE], '.')
+        self.check(["failed"], '.msg')
+        self.check([files], '.data.files')
+        self.check(files, '.data.files[]')
+        self.check(["a.c"], '.data.files[0]')
+        self.check(["c.c"], '.data["files"][-1]')
+        self.check([files[1:]], '.data.files[1:]')
+        self.check([1], '."with space"')
+        self.check([None], '.data.n.deeper')
+        self.check([None], '.missing')
+        self.check([], '.data.files.x?')
+
+    def test_operators(self):
+        self.check(["failed", "ERROR"], '.msg, .lvl')
+        self.check([3], '.data.files | length')
+        self.check([True], '.lvl == "ERROR" and .data.n == null')
+        self.check([False], '.lvl != "ERROR" or (.data.files | length) > 3')
+        self.check([True, False], 'has("msg"), has("nope")')
+        self.check([["data", "lvl", "msg", "with space"]], 'keys')
+        self.check([False], '.lvl | not')
+        self.check([], 'empty')
+        self.check([[1, "a", True, None]], '[1, "a", true, null]')
+        self.check([True, False], '1 < 2, true == 1')
+
+    def test_select_map_construct(self):
+        self.check(["failed"], 'select(.lvl == "ERROR") | .msg')
+        self.check([], 'select(.lvl == "INFO")')
+        self.check([["b.c", "c.c"]], '[.data.files[] | select(. > "a.c")]')
+        self.check([[False, True, False]], '.data.files | map(. == "b.c")')
+        self.check([{"msg": "failed", "level": "ERROR", "ERROR": 3}],
+                   '{msg, level: .lvl, (.lvl): .data.files | length}')
+        self.check([{"f": "a.c"}, {"f": "b.c"}, {"f": "c.c"}],
+                   '{f: .data.files[]}')
+
+    def test_invalid(self):
+        for query in ('.[', '.a |', 'foo', '"abc', '{1: 2}', '.a b', '-'):
+            with self.assertRaises(ValueError):
+                jshlib_query.compile_query(query)
+
+        query = jshlib_query.compile_query('.a')
+        with self.assertRaises(ValueError):
+            query([1, 2])
+
+    def test_query_iter(self):
+        text = '{"lvl": "INFO", "msg": "a"}\n{"lvl": "ERROR", "msg": "b"}\n'
+        result = jshlib_query.query_iter('select(.lvl == "ERROR") | .msg',
+                                         jshlib.load_json_iter(text))
+        assert ["b"] == list(result)
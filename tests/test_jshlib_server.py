@@ -0,0 +1,112 @@
+import os
+import json
+import socket
+import tempfile
+import threading
+import unittest
+import http.client
+
+import jshlib
+import jshlib_server
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+ECHO = os.path.join(TESTS, 'echo')
+
+
+def serve(srv):
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+class TestJshServer(unittest.TestCase):
+    def setUp(self):
+        self.jsh = jshlib_server.JshServer({"echo": ECHO},
+                                           max_workers=2,
+                                           max_queue=1)
+        self.warm = jshlib_server.JshServer({"echo": ECHO}, warm=["echo"])
+        self.addCleanup(self.warm.close)
+
+    def test_handle(self):
+        records = list(self.jsh.handle(jshlib.Request("echo", {"a": 1}, 7)))
+        assert [{"log": jshlib.request("echo", {"a": 1})},
+                jshlib.response({"returncode": 0}, 7)] == records
+
+        records = list(self.jsh.handle(jshlib.Request("echo", {"a": 1}, 8)))
+        assert 8 == records[-1]["id"]
+
+        records = list(self.jsh.handle(jshlib.Request("unknown", None, 1)))
+        assert jshlib.Error.METHOD_NOT_FOUND == records[0]["error"]["code"]
+
+        stats = next(self.jsh.handle(jshlib.Request("jsh.stats", None, 2)))
+        assert {"accepted": 2, "completed": 2, "running": 0, "queued": 0,
+                "rejected": 0} == {k: stats["result"][k] for k in (
+                    "accepted", "completed", "running", "queued", "rejected")}
+
+    def test_warm(self):
+        records = list(self.warm.handle(jshlib.Request("echo", {"a": 1}, 3)))
+        assert [{"out": {"a": 1}}, jshlib.response({"returncode": 0},
+                                                   3)] == records
+
+    def test_admission(self):
+        # two running and one queued, started but not finished
+        held = [self.jsh.handle(jshlib.Request("echo", None, i))
+                for i in range(2)]
+        for records in held:
+            assert "log" in next(records)
+
+        queued = self.jsh.handle(jshlib.Request("echo", None, 2))
+        thread = threading.Thread(target=list, args=(queued, ))
+        thread.start()
+        while self.jsh.stats()["queued"] != 1:
+            thread.join(0.01)
+
+        busy = list(self.jsh.handle(jshlib.Request("echo", None, 3)))
+        assert jshlib_server.SERVER_BUSY == busy[0]["error"]["code"]
+
+        for records in held:
+            list(records)
+        thread.join()
+        stats = self.jsh.stats()
+        assert 1 == stats["rejected"] == stats["max_queued"]
+        assert 3 == stats["completed"]
+
+    def test_unix(self):
+        path = os.path.join(tempfile.mkdtemp(), "jsh.sock")
+        srv = self.warm.unix_server(path)
+        serve(srv)
+        self.addCleanup(srv.server_close)
+        self.addCleanup(srv.shutdown)
+
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(path)
+            sock.sendall(b'{"jsonrpc": "2.0", "method": "jsh.stats", "id": 1}\n'
+                         b'not json\n'
+                         b'{"jsonrpc": "2.0", "method": "echo", "id": 2}\n')
+            sock.shutdown(socket.SHUT_WR)
+            records = list(jshlib.load_json_iter(sock.makefile('rb')))
+
+        assert 0 == records[0]["result"]["running"]
+        assert jshlib.Error.PARSE_ERROR == records[1]["error"]["code"]
+        assert [{"out": None},
+                jshlib.response({"returncode": 0}, 2)] == records[2:]
+
+    def test_http(self):
+        srv = self.jsh.http_server()
+        serve(srv)
+        self.addCleanup(srv.server_close)
+        self.addCleanup(srv.shutdown)
+
+        conn = http.client.HTTPConnection(*srv.server_address)
+        conn.request("POST", "/", json.dumps(jshlib.request("echo", id=1)))
+        resp = conn.getresponse()
+        assert 200 == resp.status
+        assert jshlib_server.NDJSON == resp.getheader("Content-Type")
+        assert [{"log": jshlib.request("echo")},
+                jshlib.response({"returncode": 0}, 1)] == list(
+                    jshlib.load_json_iter(resp.read()))
+
+        conn = http.client.HTTPConnection(*srv.server_address)
+        conn.request("GET", "/stats")
+        stats = json.loads(conn.getresponse().read())
+        assert 1 == stats["completed"]